@@ -1,18 +1,29 @@
 from __future__ import absolute_import
 
+import os
 import re
+import time
+import threading
 import sublime
 import sublime_plugin
 from itertools import chain
 
 from .settings import Settings, SettingTogglerCommandMixin
-from .colorizer import SchemaColorizer
+from .colorizer import SchemaColorizer, writer
+from .search import cache, Pattern, alternation, find_all_patterns, count_patterns, selector_regions, line_spans, inside, viewport_region, uncovered, cover
+from .words import is_word, get_index, update_index, drop_index
+from .marks import get_marks, clear_marks, drop_marks, store
+from .stats import stats, clock, timed
+from .trace import recorder
+from .project import walk, search_file, get_pool
 
 NAME = "Text Marker"
 VERSION = "1.2.3"
 
 DEFAULT_COLORS = ['comment']
 
+set_timeout_async = getattr(sublime, 'set_timeout_async', sublime.set_timeout)
+
 
 def regex_escape(string):
     # Sublime Text chokes when regexes contain \', \<, \>, or \`.
@@ -25,30 +36,20 @@ def regex_escape(string):
 def is_whitespace(string):
 	return (not string or string.isspace())
 
-def highlight(view, color=None, min_length=4, when_selection_is_empty=False, when_whitespace=False, add_selections=False, prefix='wh_'):
-    view_settings = view.settings()
-    word_separators = view_settings.get('word_separators')
+def make_pattern(string, whole_word, word_separators):
+    if whole_word:
+        return Pattern(r'\b%s\b' % regex_escape(string), string, string if is_word(string, word_separators) else None)
+    return Pattern(regex_escape(string), string, None)
 
-    all_regions = {}
-    for color_scope_name in chain(colorizer.colors.values(), DEFAULT_COLORS):
-        regions = view.get_regions(prefix + color_scope_name)
-        if regions:
-            all_regions[color_scope_name] = regions
 
-    def find_color(sel):
-        for color_scope_name, regions in all_regions.items():
-            for region in regions:
-                if region.contains(sel):
-                    return color_scope_name
+def selection_patterns(view, sels, min_length=4, when_selection_is_empty=False, when_whitespace=False):
+    word_separators = view.settings().get('word_separators')
 
-    colors = set()
-    view_sel = view.sel()
-    regions = []
-    for sel in view_sel:
-        # Figure out what colors are currently active in the selection
-        color_scope_name = find_color(sel)
-        if color_scope_name:
-            colors.add(color_scope_name)
+    # Many cursors often sit on the same string; each one is searched once.
+    patterns = []
+    seen = set()
+    for sel in sels:
+        pattern = None
         if sel:
             # If the selection is a range...
             string = view.substr(sel)
@@ -57,69 +58,889 @@ def highlight(view, color=None, min_length=4, when_selection_is_empty=False, whe
                 # a and b values rather than their begin() and end() values. This means
                 # that a leftward selection (with a > b) will never match the view.word()
                 # of itself. As a workaround, we compare the lengths instead.
-                if len(sel) == len(view.word(sel)):
-                    regex = r'\b%s\b' % regex_escape(string)
-                else:
-                    regex = regex_escape(string)
-                regions.extend(view.find_all(regex))
+                pattern = make_pattern(string, len(sel) == len(view.word(sel)), word_separators)
         else:
             # If selection is a point...
             if when_selection_is_empty:
                 string = view.substr(view.word(sel))
                 if string and any(c not in word_separators for c in string):
-                    regions.extend(view.find_all(r'\b%s\b' % regex_escape(string)))
+                    pattern = make_pattern(string, True, word_separators)
+        if pattern and pattern not in seen:
+            seen.add(pattern)
+            patterns.append(pattern)
+    return patterns
+
+
+def search_regions(view, patterns, region=None, index=None):
+    regions = []
+    if index is not None:
+        for pattern in patterns:
+            if pattern.word:
+                regions.extend(index.find(pattern.word, region))
+        patterns = [p for p in patterns if not p.word]
+    for found in find_all_patterns(view, patterns, region):
+        regions.extend(found)
+    return regions
+
+
+def find_regions(view, patterns, sels=(), region=None, index=None, selector=None):
+    if selector:
+        # Only the lines holding spans matching the selector get searched,
+        # each of them once, keeping the matches inside the spans.
+        regions = []
+        for lines, spans in line_spans(view, selector_regions(view, selector, region)):
+            regions.extend(inside(search_regions(view, patterns, lines, index), spans))
+    else:
+        regions = search_regions(view, patterns, region, index)
+
+    if not regions and len(sels) > 1:
+        regions = list(sels)
+
+    return regions
+
 
-    if not regions and len(view_sel) > 1:
-        regions = list(view_sel)
+def word_index(view):
+    """Return the word index of view, if enabled and the buffer isn't too large for one."""
+    if settings.get('live_word_index'):
+        return get_index(view, settings.get('live_word_index_max_size'))
 
+
+def find_regions_capped(view, patterns, sels=(), region=None, index=None, selector=None, max_regions=None):
+    """
+    Like find_regions(), but when there could be more than max_regions, the
+    search goes in slices and, once more are found, the rest only gets
+    counted. Returns the regions and their count, with no regions if over.
+
+    Whole buffer searches still use the search cache (and fill it, when not
+    over), and the word index counts its words before finding them.
+
+    """
+    begin, end = (0, view.size()) if region is None else (region.begin(), region.end())
+    if not max_regions or end - begin <= max_regions:
+        # Each match takes at least a character, so it can't go over.
+        regions = find_regions(view, patterns, sels, region, index, selector)
+        return regions, len(regions)
+
+    whole = region is None and not selector
+    if whole and index is not None and all(p.word for p in patterns):
+        count = sum(index.count(p.word) for p in patterns)
+        if count > max_regions:
+            return [], count
+        regions = find_regions(view, patterns, sels, region, index, selector)
+        return regions, len(regions)
+
+    key = (view.buffer_id(), view.change_count())
+    if whole:
+        cached = [cache.get(key + (p.regex, 0)) for p in patterns]
+        if all(c is not None for c in cached):
+            count = sum(len(c) for c in cached)
+            if count > max_regions:
+                return [], count
+            regions = [r for c in cached for r in c]
+            if not regions and len(sels) > 1:
+                regions = list(sels)
+            return regions, len(regions)
+
+    # Whole words searched for in the whole buffer are found per pattern, so
+    # they can be cached just like find_all_patterns() would.
+    per_pattern = whole and index is None and all(p.word for p in patterns)
+    found = [[] for p in patterns]
+    regions = []
+    count = None
+    pos = begin
+    while pos < end:
+        stop = min(view.full_line(min(pos + PROGRESSIVE_SLICE, end)).end(), end)
+        if count is not None:
+            if selector:
+                count += len(find_regions(view, patterns, region=sublime.Region(pos, stop), index=index, selector=selector))
+            else:
+                count += sum(count_patterns(view, patterns, region=sublime.Region(pos, stop)))
+        else:
+            if per_pattern:
+                for regions_found, matches in zip(found, find_all_patterns(view, patterns, sublime.Region(pos, stop))):
+                    regions_found.extend(matches)
+                    regions.extend(matches)
+            else:
+                regions.extend(find_regions(view, patterns, region=sublime.Region(pos, stop), index=index, selector=selector))
+            if len(regions) > max_regions:
+                # Too many to mark; from here on just count the rest.
+                count = len(regions)
+                regions = []
+                found = None
+        pos = stop
+    if count is not None:
+        return [], count
+    if per_pattern:
+        for pattern, regions_found in zip(patterns, found):
+            cache.put(key + (pattern.regex, 0), regions_found)
+    if not regions and len(sels) > 1:
+        regions = list(sels)
+    return regions, len(regions)
+
+
+def status_regions(regions):
     if regions:
         sublime.status_message("%d region%s selected" % (len(regions), "" if len(regions) == 1 else "s"))
     else:
         sublime.status_message("")
 
+
+def over_limit(count, add_selections=False):
+    """Report and return whether count is over the max_regions setting."""
+    max_regions = settings.get('max_regions')
+    if max_regions and count > max_regions:
+        sublime.status_message("%d regions found, more than max_regions (%d); not %s" % (count, max_regions, "selected" if add_selections else "marked"))
+        return True
+    return False
+
+
+def region_flags():
+    return sublime.DRAW_OUTLINED if settings.get('draw_outlined') else 0
+
+
+def pick_color(view, color=None, all_regions=()):
+    """Return the color scope name for color, or for the next default color not in all_regions."""
+    colorizer.setup_color_scheme(view.settings())
+    if not color:
+        for c in settings.get('default_colors') or DEFAULT_COLORS:
+            csn = colorizer.add_color(c)
+            if csn and csn not in all_regions:
+                color = c
+                break
+    color_scope_name = colorizer.add_color(color) or 'comment'
+    colorizer.update(view)
+    return color_scope_name
+
+
+def add_regions(view, regions, color=None, prefix='wh_', all_regions=()):
+    color_scope_name = pick_color(view, color, all_regions)
+    paint_regions(view, regions, color_scope_name, prefix)
+    return color_scope_name
+
+
+# Ids of the buffers seen with more than one view into them, so without
+# view.buffer() (ST3) the windows are only scanned for the views of those.
+cloned = set()
+
+
+def buffer_views(view):
+    """Return all the views into the buffer of view, view included."""
+    buffer = getattr(view, 'buffer', None)
+    if buffer is not None:
+        views = buffer().views()
+    elif view.is_primary() and view.buffer_id() not in cloned:
+        return [view]
+    else:
+        buffer_id = view.buffer_id()
+        views = [v for w in sublime.windows() for v in w.views() if v.buffer_id() == buffer_id]
+    if not any(v.id() == view.id() for v in views):
+        views = [view] + list(views)
+    return views
+
+
+# Regions are computed once per buffer and painted (or erased) in all the
+# views into it, so split and clone views cost as much as a single one.
+
+def paint_regions(view, regions, color_scope_name, prefix='wh_'):
+    t = clock()
+    flags = region_flags()
+    for v in buffer_views(view):
+        v.add_regions(prefix + color_scope_name, regions, color_scope_name, '', flags)
+        get_marks(v, prefix).set(v, color_scope_name, regions)
+    stats.add('add_regions', clock() - t)
+    stats.count('regions painted', len(regions))
+
+
+def unpaint_regions(view, color_scope_name, prefix='wh_'):
+    for v in buffer_views(view):
+        v.erase_regions(prefix + color_scope_name)
+        get_marks(v, prefix).erase(color_scope_name)
+
+
+def remember_marks(view, color_scope_name, patterns, selector=None, prefix='wh_'):
+    for v in buffer_views(view):
+        get_marks(v, prefix).remember(color_scope_name, patterns, selector)
+
+
+def clone_marks(view):
+    """Copy the marks of another view into the same buffer to view, returning whether there were any."""
+    for other in buffer_views(view):
+        if other.id() != view.id() and get_marks(other).scopes():
+            break
+    else:
+        return False
+    source = get_marks(other)
+    source.refresh(other)
+    marks = get_marks(view)
+    flags = region_flags()
+    for color_scope_name, marked in source.colors.items():
+        view.add_regions('wh_' + color_scope_name, marked.regions, color_scope_name, '', flags)
+        marks.set(view, color_scope_name, marked.regions)
+    for color_scope_name, patterns in source.terms.items():
+        marks.remember(color_scope_name, patterns, source.selectors.get(color_scope_name))
+    return True
+
+
+# Generation counters for asynchronous and progressive highlighting, per
+# buffer, prefix and, for marks, color (so marking a term doesn't cancel the
+# marking of another one); any result computed for an older generation is
+# stale and gets thrown away.
+generations = {}
+
+
+def next_generation(view, prefix, color_scope_name=None):
+    key = (view.buffer_id(), prefix, color_scope_name if prefix == 'wh_' else None)
+    generation = generations[key] = generations.get(key, 0) + 1
+    return lambda: generations.get(key) == generation and getattr(view, 'is_valid', lambda: True)()
+
+
+def cancel_generations(view, prefix, color_scope_name=None):
+    """Make the highlighting in progress in view stale, only that of color_scope_name if given."""
+    buffer_id = view.buffer_id()
+    for key in list(generations):
+        if key[0] == buffer_id and key[1] == prefix and color_scope_name in (None, key[2]):
+            generations[key] += 1
+
+
+def highlight(view, color=None, min_length=4, when_selection_is_empty=False, when_whitespace=False, add_selections=False, prefix='wh_', margin=None, use_index=False, selector=None):
+    start = clock()
+    marks = get_marks(view, prefix, chain(colorizer.colors.values(), DEFAULT_COLORS))
+
+    colors = set()
+    view_sel = view.sel()
+    if prefix == 'wh_':
+        for sel in view_sel:
+            # Figure out what colors are currently active in the selection
+            color_scope_name = marks.find(view, sel)
+            if color_scope_name:
+                colors.add(color_scope_name)
+    t = clock()
+    stats.add('highlight.marks', t - start)
+
+    patterns = selection_patterns(view, view_sel, min_length=min_length, when_selection_is_empty=when_selection_is_empty, when_whitespace=when_whitespace)
+    stats.add('highlight.patterns', clock() - t)
+
+    if not (prefix == 'wh_' and colors) and margin is None and settings.get('progressive') and view.size() >= (settings.get('progressive_min_size') or 0):
+        highlight_progressive(view, patterns, list(view_sel), color=color, prefix=prefix, all_regions=marks.scopes(), add_selections=add_selections, selector=selector)
+        return
+
+    if prefix != 'wh_':
+        next_generation(view, prefix)
+    t = clock()
+    region = None if margin is None else viewport_region(view, margin)
+    index = word_index(view) if use_index else None
+    # Unmarking doesn't need the regions at all, so the cap doesn't apply.
+    max_regions = None if prefix == 'wh_' and colors else settings.get('max_regions')
+    regions, count = find_regions_capped(view, patterns, sels=view_sel, region=region, index=index, selector=selector, max_regions=max_regions)
+    stats.add('highlight.search', clock() - t)
+    stats.count('regions found', len(regions))
+
+    if not (prefix == 'wh_' and colors) and over_limit(count, add_selections):
+        if prefix != 'wh_':
+            unpaint_regions(view, colorizer.add_color(color) or 'comment', prefix)
+        return
+
+    status_regions(regions)
+
+    t = clock()
     if prefix == 'wh_' and colors:
         for color_scope_name in colors:
-            view.erase_regions(prefix + color_scope_name)
+            cancel_generations(view, prefix, color_scope_name)
+            unpaint_regions(view, color_scope_name, prefix)
+        persist_marks(view)
     else:
-        colorizer.setup_color_scheme(view_settings)
-        if not color:
-            for c in settings.get('default_colors') or DEFAULT_COLORS:
-                csn = colorizer.add_color(c)
-                if csn and csn not in all_regions:
-                    color = c
-                    break
-        color_scope_name = colorizer.add_color(color) or 'comment'
-        colorizer.update(view)
-        view.add_regions(prefix + color_scope_name, regions, color_scope_name, '', (sublime.DRAW_OUTLINED if settings.get('draw_outlined') else 0))
+        color_scope_name = add_regions(view, regions, color=color, prefix=prefix, all_regions=marks.scopes())
+        if prefix == 'wh_':
+            next_generation(view, prefix, color_scope_name)
+            remember_marks(view, color_scope_name, patterns, selector)
+            persist_marks(view)
+        if region is not None:
+            track_viewport(view, patterns, region, regions, prefix, color_scope_name, margin, use_index, selector)
+
+    stats.add('highlight.paint', clock() - t)
 
     if add_selections:
         view_sel.add_all(regions)
 
+    stats.add('highlight', clock() - start)
 
-def erase_colors(view=None, prefix='wh_'):
+
+def highlight_async(view, color=None, min_length=4, when_selection_is_empty=False, when_whitespace=False, prefix='whl_', delay=0, margin=None, use_index=False, selector=None):
+    is_current = next_generation(view, prefix)
+
+    def paint(patterns, region, regions, count):
+        if not is_current():
+            return
+        if over_limit(count):
+            regions = []
+        else:
+            status_regions(regions)
+        color_scope_name = add_regions(view, regions, color=color, prefix=prefix)
+        if region is not None:
+            track_viewport(view, patterns, region, regions, prefix, color_scope_name, margin, use_index, selector)
+
+    def search():
+        if not is_current():
+            return
+        t = clock()
+        sels = list(view.sel())
+        patterns = selection_patterns(view, sels, min_length=min_length, when_selection_is_empty=when_selection_is_empty, when_whitespace=when_whitespace)
+        region = None if margin is None else viewport_region(view, margin)
+        index = word_index(view) if use_index else None
+        regions, count = find_regions_capped(view, patterns, sels=sels, region=region, index=index, selector=selector, max_regions=settings.get('max_regions'))
+        stats.add('highlight_async.search', clock() - t)
+        stats.count('regions found', len(regions))
+        sublime.set_timeout(lambda: paint(patterns, region, regions, count), 0)
+
+    # Bursts of events within the delay collapse into a single search, and
+    # the search itself runs off the UI thread.
+    set_timeout_async(search, delay)
+
+
+PROGRESSIVE_SLICE = 1 << 20  # characters searched per step
+
+
+def highlight_progressive(view, patterns, sels, color=None, prefix='wh_', all_regions=(), add_selections=False, selector=None):
+    """
+    Highlight patterns in view in time-sliced steps.
+
+    The visible region is searched and painted right away; the rest of the
+    buffer is then searched in line aligned slices, as many per step as fit
+    in the time budget, with the next step scheduled through set_timeout.
+
+    """
+    budget = (settings.get('progressive_budget') or 20) / 1000.0
+
+    visible = find_regions(view, patterns, region=view.visible_region(), selector=selector)
+    color_scope_name = add_regions(view, visible, color=color, prefix=prefix, all_regions=all_regions)
+    is_current = next_generation(view, prefix, color_scope_name)
+    if prefix == 'wh_':
+        remember_marks(view, color_scope_name, patterns, selector, prefix)
+        persist_marks(view)
+
+    max_regions = settings.get('max_regions')
+    state = {}
+
+    def start(visible):
+        state.update(pos=0, regions=[], visible=visible, painted=len(visible), count=None, change_count=view.change_count(), size=view.size())
+
+    def step():
+        if not is_current():
+            view.erase_status('text_marker_progress')
+            return
+        if view.change_count() != state['change_count']:
+            # The buffer changed, start over (the visible region first).
+            visible = find_regions(view, patterns, region=view.visible_region(), selector=selector)
+            start(visible)
+            if visible:
+                paint_regions(view, visible, color_scope_name, prefix)
+        size = state['size']
+        regions = state['regions']
+        pos = state['pos']
+        deadline = time.time() + budget
+        while pos < size and time.time() < deadline:
+            end = view.full_line(min(pos + PROGRESSIVE_SLICE, size)).end()
+            if state['count'] is None:
+                regions.extend(find_regions(view, patterns, region=sublime.Region(pos, end), selector=selector))
+                if max_regions and len(regions) > max_regions:
+                    # Too many to mark; from here on just count the rest.
+                    state['count'] = len(regions)
+                    del regions[:]
+                    unpaint_regions(view, color_scope_name, prefix)
+                    if prefix == 'wh_':
+                        persist_marks(view)
+            elif selector:
+                state['count'] += len(find_regions(view, patterns, region=sublime.Region(pos, end), selector=selector))
+            else:
+                state['count'] += sum(count_patterns(view, patterns, region=sublime.Region(pos, end)))
+            pos = end
+        state['pos'] = pos
+        if state['count'] is not None:
+            if pos < size:
+                view.set_status('text_marker_progress', "Text Marker: %d%% (%d regions, counting)" % (100 * pos // size, state['count']))
+                sublime.set_timeout(step, 0)
+            else:
+                view.erase_status('text_marker_progress')
+                over_limit(state['count'], add_selections)
+        elif pos < size:
+            # Repaint only once the regions found doubled, so painting as a
+            # whole stays linear in the number of regions. The visible ones
+            # the search already went past are in regions.
+            if len(regions) >= 2 * state['painted']:
+                paint_regions(view, regions + [r for r in state['visible'] if r.begin() >= pos], color_scope_name, prefix)
+                state['painted'] = len(regions)
+            view.set_status('text_marker_progress', "Text Marker: %d%% (%d regions)" % (100 * pos // size, len(regions)))
+            sublime.set_timeout(step, 0)
+        else:
+            view.erase_status('text_marker_progress')
+            if not regions and len(sels) > 1:
+                regions = sels
+            paint_regions(view, regions, color_scope_name, prefix)
+            status_regions(regions)
+            if add_selections:
+                view.sel().add_all(regions)
+
+    start(visible)
+    sublime.set_timeout(step, 0)
+
+
+################################################################################
+# Viewport-limited highlighting: only the visible region (plus a margin) gets
+# searched, and the searched area grows as the view is scrolled.
+
+VIEWPORT_POLL = 100  # ms
+
+
+class Viewport(object):
+    def __init__(self, view, patterns, region, regions, prefix, color_scope_name, margin, use_index, selector=None):
+        self.change_count = view.change_count()
+        self.patterns = patterns
+        self.covered = cover([], region)
+        self.regions = list(regions)
+        self.prefix = prefix
+        self.color_scope_name = color_scope_name
+        self.margin = margin
+        self.use_index = use_index
+        self.selector = selector
+
+    def extend(self, view):
+        gaps = uncovered(viewport_region(view, self.margin), self.covered)
+        if not gaps:
+            return
+        index = word_index(view) if self.use_index else None
+        for gap in gaps:
+            # Searching goes by whole lines, and a gap can start at the end
+            # of a line already covered, whose matches are in already.
+            found = find_regions(view, self.patterns, region=gap, index=index, selector=self.selector)
+            self.regions.extend(r for r in found if gap.begin() <= r.begin() < gap.end())
+            self.covered = cover(self.covered, gap)
+        paint_regions(view, self.regions, self.color_scope_name, self.prefix)
+
+
+viewports = {}
+polling = False  # whether poll_viewports() is scheduled
+
+
+def track_viewport(view, patterns, region, regions, prefix, color_scope_name, margin, use_index, selector=None):
+    global polling
+    if not patterns:
+        viewports.pop(view.id(), None)
+        return
+    viewports[view.id()] = Viewport(view, patterns, region, regions, prefix, color_scope_name, margin, use_index, selector)
+    if not polling:
+        polling = True
+        sublime.set_timeout(poll_viewports, VIEWPORT_POLL)
+
+
+def poll_viewports():
+    global polling
+    window = sublime.active_window()
+    view = window and window.active_view()
     if view:
-        for color_scope_name in chain(colorizer.colors.values(), ['comment']):
-            view.erase_regions(prefix + color_scope_name)
+        viewport = viewports.get(view.id())
+        if viewport:
+            if viewport.change_count == view.change_count():
+                viewport.extend(view)
+            else:
+                viewports.pop(view.id(), None)
+    if viewports:
+        sublime.set_timeout(poll_viewports, VIEWPORT_POLL)
     else:
-        for window in sublime.windows():
-            for view in window.views():
-                erase_colors(view)
+        polling = False
 
 
-class TextMarkerListener(sublime_plugin.EventListener):
-    live = False
+################################################################################
+# Persistent marks: the terms marked in each file are saved, and restored in
+# the background the first time the view is activated.
+
+restored = set()
+
+
+def persist_marks(view):
+    file_name = view.file_name()
+    if file_name and settings.get('persistent_marks'):
+        marks = get_marks(view)
+        terms = []
+        for color_scope_name, patterns in marks.terms.items():
+            selector = marks.selectors.get(color_scope_name)
+            for pattern in patterns:
+                term = [color_scope_name, pattern.string, 'word' if pattern.regex.startswith(r'\b') else 'text']
+                if selector:
+                    term.append(selector)
+                terms.append(term)
+        store.set(file_name, terms)
+
 
+def restore_marks(view):
+    restored.add(view.id())
+    file_name = view.file_name()
+    terms = file_name and store.get(file_name)
+    if not terms:
+        return
+    word_separators = view.settings().get('word_separators')
+    by_color = {}
+    selectors = {}
+    for term in terms:
+        color_scope_name, string, mode = term[:3]
+        by_color.setdefault(color_scope_name, []).append(make_pattern(string, mode == 'word', word_separators))
+        if len(term) > 3:
+            selectors[color_scope_name] = term[3]
+    mark_terms(view, by_color, selectors)
+
+
+def mark_terms(view, by_color, selectors=None):
+    """
+    Mark the patterns of each color scope name in by_color, searching in the
+    background, only in the scopes matching its selector in selectors if any.
+
+    """
+    selectors = selectors or {}
+    change_count = view.change_count()
+
+    def paint(color_scope_name, patterns, regions):
+        if not getattr(view, 'is_valid', lambda: True)() or view.change_count() != change_count:
+            return
+        color = colorizer.region_color(color_scope_name)
+        selector = selectors.get(color_scope_name)
+        color_scope_name = add_regions(view, regions, color=color)
+        remember_marks(view, color_scope_name, patterns, selector)
+
+    def search():
+        for color_scope_name, patterns in by_color.items():
+            regions = find_regions(view, patterns, selector=selectors.get(color_scope_name))
+            sublime.set_timeout(lambda c=color_scope_name, p=patterns, r=regions: paint(c, p, r), 0)
+
+    set_timeout_async(search, 0)
+
+
+################################################################################
+# Marking across views: buffers are searched in the background, and the
+# results get painted right away in the visible views, but only once they're
+# activated in the others, so marking in many tabs doesn't freeze the UI.
+
+# Buffer id -> (change count, color scope name, patterns, regions) waiting for
+# a view into the buffer to be activated.
+pending = {}
+
+
+def visible_views():
+    """Return the ids of the views currently shown in any group of any window."""
+    ids = set()
+    for window in sublime.windows():
+        for group in range(window.num_groups()):
+            view = window.active_view_in_group(group)
+            if view:
+                ids.add(view.id())
+    return ids
+
+
+def mark_views(view, views, color=None):
+    """Toggle marking the terms selected in view in all of views."""
+    marks = get_marks(view, 'wh_', chain(colorizer.colors.values(), DEFAULT_COLORS))
+    colors = set(filter(None, (marks.find(view, sel) for sel in view.sel())))
+    if colors:
+        for v in views:
+            for color_scope_name in colors:
+                cancel_generations(v, 'wh_', color_scope_name)
+                unpaint_regions(v, color_scope_name)
+            if v.buffer_id() in pending and pending[v.buffer_id()][1] in colors:
+                del pending[v.buffer_id()]
+            persist_marks(v)
+        return
+
+    patterns = selection_patterns(view, view.sel(), min_length=4, when_selection_is_empty=True, when_whitespace=True)
+    if not patterns:
+        return
+    # The color must be free in all of the views, else it would replace the
+    # marks of that color in the ones using it already.
+    in_use = set(marks.scopes())
+    for v in views:
+        in_use.update(get_marks(v).scopes())
+        if v.buffer_id() in pending:
+            in_use.add(pending[v.buffer_id()][1])
+    color_scope_name = pick_color(view, color, in_use)
+    # Search each buffer once, through one of its visible views if any, as
+    # painting goes to all the views into the buffer anyway.
+    visible = visible_views()
+    buffers = {}
+    for v in views:
+        if v.buffer_id() not in buffers or v.id() in visible:
+            buffers[v.buffer_id()] = v
+    views = [(v, v.change_count()) for v in buffers.values()]
+
+    def apply(v, change_count, regions):
+        if not regions or not v.is_valid() or v.change_count() != change_count:
+            return
+        visible = visible_views()
+        shown = [b for b in buffer_views(v) if b.id() in visible]
+        if shown:
+            paint_marks(shown[0], color_scope_name, patterns, regions)
+        else:
+            pending[v.buffer_id()] = (change_count, color_scope_name, patterns, regions)
+
+    def search():
+        for v, change_count in views:
+            if v.is_valid() and v.change_count() == change_count:
+                regions = find_regions(v, patterns)
+                sublime.set_timeout(lambda v=v, c=change_count, r=regions: apply(v, c, r), 0)
+
+    set_timeout_async(search, 0)
+
+
+def paint_marks(view, color_scope_name, patterns, regions):
+    if over_limit(len(regions)):
+        return
+    paint_regions(view, regions, color_scope_name)
+    remember_marks(view, color_scope_name, patterns)
+    persist_marks(view)
+
+
+def apply_pending(view):
+    change_count, color_scope_name, patterns, regions = pending.pop(view.buffer_id())
+    if view.change_count() == change_count:
+        paint_marks(view, color_scope_name, patterns, regions)
+        return
+
+    # The buffer changed in the meantime, search it again.
+    def paint(change_count, regions):
+        if regions and view.is_valid() and view.change_count() == change_count:
+            paint_marks(view, color_scope_name, patterns, regions)
+
+    def search():
+        change_count = view.change_count()
+        regions = find_regions(view, patterns)
+        sublime.set_timeout(lambda: paint(change_count, regions), 0)
+
+    set_timeout_async(search, 0)
+
+
+################################################################################
+# Project search: the marked terms are searched for in the files of the
+# window's folders, on disk, by a pool of workers; the results stream into an
+# output panel, and files opened from there get the terms marked.
+
+PROJECT_PANEL = 'text_marker_project'
+PROJECT_FLUSH = 0.1  # seconds between appends to the results panel
+
+# File name -> {color scope name: patterns} to mark once the file is opened.
+project_marks = {}
+
+# Window id -> generation of the project search running in it.
+project_searches = {}
+
+
+def project_folders(window):
+    """Return the window's folders as (path, folder exclude patterns, file exclude patterns) tuples."""
+    data = getattr(window, 'project_data', lambda: None)() or {}
+    entries = data.get('folders') or []
+    folders = []
+    for i, path in enumerate(window.folders()):
+        entry = entries[i] if i < len(entries) else {}
+        folders.append((path, entry.get('folder_exclude_patterns') or [], entry.get('file_exclude_patterns') or []))
+    return folders
+
+
+def output_panel(window, name):
+    create_output_panel = getattr(window, 'create_output_panel', None) or window.get_output_panel
+    return create_output_panel(name)
+
+
+def append_panel(panel, text):
+    panel.run_command('append', {'characters': text, 'force': True, 'scroll_to_end': False})
+
+
+def find_in_project(window, by_color):
+    """Search the files of the window's folders for the patterns of each color in by_color."""
+    key = window.id()
+    generation = project_searches[key] = project_searches.get(key, 0) + 1
+
+    def is_current():
+        return project_searches.get(key) == generation
+
+    view = window.active_view()
+    view_settings = view.settings() if view else sublime.load_settings('Preferences.sublime-settings')
+    folder_excludes = view_settings.get('folder_exclude_patterns') or []
+    file_excludes = (view_settings.get('file_exclude_patterns') or []) + (view_settings.get('binary_file_patterns') or [])
+    folders = project_folders(window)
+
+    patterns = [p for ps in by_color.values() for p in ps]
+    by_string = dict((p.string, (color_scope_name, p)) for color_scope_name, ps in by_color.items() for p in ps)
+    regex = alternation(patterns).encode('utf-8')
+
+    panel = output_panel(window, PROJECT_PANEL)
+    panel_settings = panel.settings()
+    panel_settings.set('result_file_regex', r'^(\S.*):$')
+    panel_settings.set('result_line_regex', r'^\s+([0-9]+):')
+    panel_settings.set('word_wrap', False)
+    append_panel(panel, "Searching %d folder%s for %s\n\n" % (len(folders), "" if len(folders) == 1 else "s", ", ".join(p.string for p in patterns)))
+    window.run_command('show_panel', {'panel': 'output.' + PROJECT_PANEL})
+
+    def flush(text, files):
+        if is_current():
+            project_marks.update(files)
+            append_panel(panel, text)
+
+    def search():
+        pool = get_pool()
+        text = []
+        files = {}
+        found = matched = 0
+        last = time.time()
+        try:
+            jobs = ((path, regex, 0) for path in walk(folders, folder_excludes, file_excludes))
+            for path, lines, error in pool.imap_unordered(search_file, jobs, 16):
+                if not is_current():
+                    return
+                if not lines:
+                    continue
+                found += 1
+                matched += len(lines)
+                terms = {}
+                for line_no, line, strings in lines:
+                    for string in strings:
+                        color_scope_name, pattern = by_string.get(string, (None, None))
+                        if pattern and pattern not in terms.setdefault(color_scope_name, []):
+                            terms[color_scope_name].append(pattern)
+                files[os.path.normpath(path)] = terms
+                text.append("%s:\n%s\n\n" % (path, "\n".join("%7d: %s" % (line_no, line) for line_no, line, strings in lines)))
+                if time.time() - last > PROJECT_FLUSH:
+                    last = time.time()
+                    sublime.set_timeout(lambda t=''.join(text), f=files: flush(t, f), 0)
+                    text = []
+                    files = {}
+            text.append("%d matching line%s in %d file%s\n" % (matched, "" if matched == 1 else "s", found, "" if found == 1 else "s"))
+            sublime.set_timeout(lambda t=''.join(text), f=files: flush(t, f), 0)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    thread = threading.Thread(target=search)
+    thread.daemon = True
+    thread.start()
+
+
+def mark_project_file(view):
+    file_name = view.file_name()
+    if not file_name or view.is_loading():
+        return
+    by_color = project_marks.pop(os.path.normpath(file_name), None)
+    if by_color:
+        marked = get_marks(view).terms
+        mark_terms(view, dict((c, ps) for c, ps in by_color.items() if c not in marked))
+
+
+def erase_colors(view=None, prefix='wh_'):
+    views = buffer_views(view) if view else [v for w in sublime.windows() for v in w.views()]
+    for v in views:
+        cancel_generations(v, prefix)
+        # Only the keys actually in use in the view need erasing.
+        for color_scope_name in get_marks(v, prefix, chain(colorizer.colors.values(), DEFAULT_COLORS)).scopes():
+            v.erase_regions(prefix + color_scope_name)
+        clear_marks(v, prefix)
+        if prefix == 'wh_':
+            pending.pop(v.buffer_id(), None)
+            persist_marks(v)
+
+
+def erase_live():
+    """Erase the live highlights from all the views that have them."""
+    for window in sublime.windows():
+        for view in window.views():
+            if view.id() in live_views:
+                erase_colors(view, prefix='whl_')
+    live_views.clear()
+    viewports.clear()
+
+
+# Ids of the views with live highlights
+live_views = set()
+
+
+class TextMarkerListener(sublime_plugin.EventListener):
     def on_selection_modified(self, view):
+        if recorder.active:
+            recorder.selection(view)
         if settings.get('live'):
-            self.live = True
+            t = clock()
+            live_views.add(view.id())
             color = settings.get('live_color') or 'comment'
             min_length = settings.get('min_length')
             when_selection_is_empty = settings.get('when_selection_is_empty')
             when_whitespace = settings.get('when_whitespace')
-            highlight(view, color=color, min_length=min_length, when_selection_is_empty=when_selection_is_empty, when_whitespace=when_whitespace, prefix='whl_')
-        elif self.live:
+            margin = (settings.get('live_viewport_margin') or 0) if settings.get('live_viewport') else None
+            # Only a few hundred lines get searched in a viewport, the index
+            # wouldn't make much of a difference there.
+            use_index = settings.get('live_word_index') and margin is None
+            selector = settings.get('live_selector') or None
+            stats.add('live.settings', clock() - t)
+            if settings.get('live_async'):
+                delay = settings.get('live_delay') or 0
+                highlight_async(view, color=color, min_length=min_length, when_selection_is_empty=when_selection_is_empty, when_whitespace=when_whitespace, prefix='whl_', delay=delay, margin=margin, use_index=use_index, selector=selector)
+            else:
+                highlight(view, color=color, min_length=min_length, when_selection_is_empty=when_selection_is_empty, when_whitespace=when_whitespace, prefix='whl_', margin=margin, use_index=use_index, selector=selector)
+        elif view.id() in live_views:
             erase_colors(view, prefix='whl_')
-            self.live = False
+            viewports.pop(view.id(), None)
+            live_views.discard(view.id())
+
+    def on_modified(self, view):
+        if recorder.active:
+            recorder.modified(view)
+
+    def restore(self, view):
+        # A new clone gets the marks of the views into the same buffer. Views
+        # still loading are left for on_load(), their text isn't there yet.
+        if view.id() in restored or view.is_loading():
+            return
+        if not view.is_primary():
+            cloned.add(view.buffer_id())
+        if clone_marks(view):
+            restored.add(view.id())
+        elif settings.get('persistent_marks'):
+            restore_marks(view)
+
+    def on_activated(self, view):
+        self.restore(view)
+        if view.buffer_id() in pending:
+            apply_pending(view)
+        if project_marks:
+            mark_project_file(view)
+
+    def on_clone(self, view):
+        cloned.add(view.buffer_id())
+
+    def on_load(self, view):
+        self.restore(view)
+        if project_marks:
+            mark_project_file(view)
+
+    def on_activated_async(self, view):
+        colorizer.check_color_scheme()
+
+    def on_close(self, view):
+        viewports.pop(view.id(), None)
+        drop_marks(view)
+        restored.discard(view.id())
+        live_views.discard(view.id())
+        others = [v for v in buffer_views(view) if v.id() != view.id()]
+        if len(others) <= 1:
+            cloned.discard(view.buffer_id())
+        if not others:
+            for key in [k for k in generations if k[0] == view.buffer_id()]:
+                del generations[key]
+            pending.pop(view.buffer_id(), None)
+            drop_index(view)
+
+
+if hasattr(sublime_plugin, 'TextChangeListener'):
+    class TextMarkerTextChangeListener(sublime_plugin.TextChangeListener):
+        def on_text_changed(self, changes):
+            view = self.buffer.primary_view()
+            if view:
+                changes = [(c.a.pt, c.b.pt, len(c.str)) for c in changes]
+                if recorder.active:
+                    recorder.changes(view, changes)
+                update_index(view, changes)
 
 
 # command to restore color scheme
@@ -140,24 +961,131 @@ class TextMarkerResetCommand(sublime_plugin.TextCommand):
         colorizer.setup_color_scheme(self.view.settings())
 
 
+class TextMarkerShowStatsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        text = "%s %s performance stats\n\n" % (NAME, VERSION)
+        text += stats.report({
+            'search cache hits': cache.hits,
+            'search cache misses': cache.misses,
+            'search cache regions': cache.size,
+        })
+        panel = output_panel(self.window, 'text_marker_stats')
+        panel.run_command('append', {'characters': text})
+        self.window.run_command('show_panel', {'panel': 'output.text_marker_stats'})
+
+
+class TextMarkerCountCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        view = self.view
+        patterns = selection_patterns(view, view.sel(), min_length=4, when_selection_is_empty=True, when_whitespace=True)
+        index = word_index(view)
+        if index is not None and all(p.word for p in patterns):
+            counts = [index.count(p.word) for p in patterns]
+        else:
+            counts = count_patterns(view, patterns)
+        if not patterns:
+            sublime.status_message("")
+        elif len(patterns) == 1:
+            sublime.status_message("%d occurrence%s of %s" % (counts[0], "" if counts[0] == 1 else "s", patterns[0].string))
+        else:
+            sublime.status_message("%d occurrences (%s)" % (sum(counts), ", ".join("%s: %d" % (p.string, c) for p, c in zip(patterns, counts))))
+
+
+class TextMarkerFindInProjectCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        view = self.window.active_view()
+        by_color = view and get_marks(view).terms
+        if not by_color:
+            sublime.status_message("%s: nothing marked to search for" % NAME)
+        elif not self.window.folders():
+            sublime.status_message("%s: no folders to search in" % NAME)
+        else:
+            find_in_project(self.window, by_color)
+
+
+class TextMarkerNextCommand(sublime_plugin.TextCommand):
+    """
+    Move the selection to the next (or previous) mark, wrapping around the
+    ends of the buffer; color limits it to the marks of that color, or to
+    the color of the mark at the caret when it's "<current>", and live to
+    include live highlights.
+
+    """
+
+    def run(self, edit, forward=True, color=None, live=True):
+        view = self.view
+        view_sel = view.sel()
+        if not len(view_sel):
+            return
+        sel = view_sel[-1] if forward else view_sel[0]
+        all_marks = [get_marks(view, prefix, chain(colorizer.colors.values(), DEFAULT_COLORS)) for prefix in (('wh_', 'whl_') if live else ('wh_',))]
+
+        color_scope_name = None
+        if color == "<current>":
+            color_scope_name = next((c for c in (marks.find(view, sel) for marks in all_marks) if c), None)
+            if color_scope_name is None:
+                sublime.status_message("%s: no mark at the cursor" % NAME)
+                return
+        elif color:
+            normalized = colorizer.normalize(color)
+            color_scope_name = colorizer.region_name(normalized) if normalized else color
+
+        found = [r for r in (marks.navigate(view, sel.begin(), forward, color_scope_name) for marks in all_marks) if r is not None]
+        if not found:
+            # Wrap around to the first (or last) mark.
+            bounds = [marks.bounds(view, color_scope_name)[0 if forward else 1] for marks in all_marks]
+            found = [r for r in bounds if r is not None]
+            if not found:
+                sublime.status_message("%s: no marks" % NAME)
+                return
+            sublime.status_message("%s: wrapped around" % NAME)
+        region = min(found, key=lambda r: r.begin()) if forward else max(found, key=lambda r: r.begin())
+        view_sel.clear()
+        view_sel.add(region)
+        view.show(region)
+
+
+class TextMarkerWindowCommand(sublime_plugin.WindowCommand):
+    def run(self, color=None, all_windows=False):
+        view = self.window.active_view()
+        if view:
+            windows = sublime.windows() if all_windows else [self.window]
+            mark_views(view, [v for w in windows for v in w.views()], color=color)
+
+
 class TextMarkerCommand(sublime_plugin.TextCommand):
-    def run(self, edit, color=None):
+    def run(self, edit, color=None, selector=None):
+        if selector is None:
+            selector = settings.get('selector')
+        self.selector = selector or None
         if color == "<select>":
-            highlight(self.view, min_length=4, when_selection_is_empty=True, when_whitespace=True, add_selections=True)
+            highlight(self.view, min_length=4, when_selection_is_empty=True, when_whitespace=True, add_selections=True, selector=self.selector)
         elif color == "<input>":
             self.view.window().show_input_panel("Color:", "", self.on_done, None, None)
         else:
-            highlight(self.view, color=color, min_length=4, when_selection_is_empty=True, when_whitespace=True)
+            highlight(self.view, color=color, min_length=4, when_selection_is_empty=True, when_whitespace=True, selector=self.selector)
 
     def on_done(self, color):
         if color:
-            highlight(self.view, color=color, min_length=4, when_selection_is_empty=True, when_whitespace=True)
+            highlight(self.view, color=color, min_length=4, when_selection_is_empty=True, when_whitespace=True, selector=self.selector)
 
 
 ################################################################################
 # Initialize settings and main objects only once
 class TextMarkerSettings(Settings):
-    pass
+    def on_update(self):
+        cache.max_regions = self.get('search_cache_max_regions', cache.max_regions)
+        if not cache.max_regions:
+            cache.clear()
+        colorizer.override = bool(self.get('color_scheme_override')) and int(sublime.version()) >= 3150
+        # Reading the color scheme can wait until loading plugins is done.
+        sublime.set_timeout(provision_colors, 0)
+        if not self.get('live') and live_views:
+            erase_live()
+        if self.get('trace') and not recorder.active:
+            sublime.status_message("%s: recording trace to %s" % (NAME, recorder.begin(dict(self.settings))))
+        elif not self.get('trace') and recorder.active:
+            sublime.status_message("%s: trace saved to %s" % (NAME, recorder.end()))
 
 
 settings = TextMarkerSettings(NAME)
@@ -171,10 +1099,60 @@ if 'colorizer' not in globals():
     colorizer = SchemaColorizer()
 
 
+def command_colors():
+    """Return the colors used by the commands in Default.sublime-commands."""
+    try:
+        commands = sublime.decode_value(sublime.load_resource('Packages/%s/Default.sublime-commands' % __package__))
+    except Exception:
+        return []
+    colors = []
+    for command in commands:
+        color = (command.get('args') or {}).get('color')
+        if color and not color.startswith('<'):
+            colors.append(color)
+    return colors
+
+
+commands_colors = None
+
+
+def palette_colors():
+    global commands_colors
+    if commands_colors is None:
+        commands_colors = command_colors()
+    colors = list(settings.get('default_colors') or [])
+    live_color = settings.get('live_color')
+    if live_color:
+        colors.append(live_color)
+    colors.extend(commands_colors)
+    return colors
+
+
+def provision_colors():
+    """Write the rules for the whole palette to the color scheme in one go."""
+    colorizer.palette = palette_colors()
+    window = sublime.active_window()
+    view = window and window.active_view()
+    if view:
+        colorizer.setup_color_scheme(view.settings())
+        colorizer.add_colors(colorizer.palette)
+        colorizer.update(view)
+
+
 ################################################################################
 
+@timed('plugin_loaded')
 def plugin_loaded():
     settings.load()
+    preferences = sublime.load_settings('Preferences.sublime-settings')
+    preferences.clear_on_change(NAME)
+    preferences.add_on_change(NAME, provision_colors)
+
+
+def plugin_unloaded():
+    sublime.load_settings('Preferences.sublime-settings').clear_on_change(NAME)
+    # Don't lose color scheme writes still waiting to happen.
+    writer.flush()
 
 
 # ST3 features a plugin_loaded hook which is called when ST's API is ready.
@@ -0,0 +1,235 @@
+"""
+Loads Text Marker against the headless sublime stand-in in this directory.
+
+The plugin is imported as a package named after its directory, just like
+Sublime Text does, so its relative imports and resource paths keep working.
+
+"""
+from __future__ import absolute_import
+
+import os
+import re
+import sys
+import time
+import types
+import random
+import importlib
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+PACKAGE = os.path.basename(ROOT)
+
+if BENCH not in sys.path:
+    sys.path.insert(0, BENCH)
+
+import sublime  # noqa: E402 (the stand-in)
+
+sublime.packages[PACKAGE] = ROOT
+
+clock = getattr(time, 'perf_counter', time.time)
+
+SETTINGS = 'Text Marker.sublime-settings'
+
+JSON_SCHEME = 'Packages/Color Scheme - Default/Monokai.sublime-color-scheme'
+TMTHEME_SCHEME = 'Packages/Color Scheme - Default/Monokai.tmTheme'
+
+SCOPES = ['comment', 'string', 'constant.numeric', 'constant.language', 'keyword', 'storage.type',
+          'entity.name.function', 'entity.name.class', 'variable.parameter', 'support.function']
+
+
+def scheme_rules(n):
+    return [('%s.bench%d' % (SCOPES[i % len(SCOPES)], i), '#%06x' % ((i * 2654435761) & 0xffffff)) for i in range(n)]
+
+
+def write_schemes(rules=300):
+    """(Re)write the stock color schemes, with rules rules in each."""
+    path = os.path.join(sublime.packages_path(), 'Color Scheme - Default')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name in os.listdir(path):
+        os.remove(os.path.join(path, name))
+    user = os.path.join(sublime.packages_path(), 'User')
+    if os.path.isdir(user):
+        for name in os.listdir(user):
+            if name.endswith('.sublime-color-scheme'):
+                os.remove(os.path.join(user, name))
+
+    rules = scheme_rules(rules)
+    with open(os.path.join(path, 'Monokai.sublime-color-scheme'), 'w') as f:
+        f.write('{\n\t"name": "Monokai",\n\t"globals": {\n\t\t"background": "#272822",\n\t\t"foreground": "#f8f8f2"\n\t},\n\t"rules": [\n')
+        f.write(',\n'.join('\t\t{\n\t\t\t"scope": "%s",\n\t\t\t"foreground": "%s"\n\t\t}' % r for r in rules))
+        f.write('\n\t]\n}\n')
+    with open(os.path.join(path, 'Monokai.tmTheme'), 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+                '<plist version="1.0">\n<dict>\n\t<key>name</key>\n\t<string>Monokai</string>\n\t<key>settings</key>\n\t<array>\n'
+                '\t\t<dict>\n\t\t\t<key>settings</key>\n\t\t\t<dict>\n'
+                '\t\t\t\t<key>background</key>\n\t\t\t\t<string>#272822</string>\n'
+                '\t\t\t\t<key>foreground</key>\n\t\t\t\t<string>#F8F8F2</string>\n'
+                '\t\t\t</dict>\n\t\t</dict>\n')
+        for scope, color in rules:
+            f.write('\t\t<dict>\n\t\t\t<key>scope</key>\n\t\t\t<string>%s</string>\n'
+                    '\t\t\t<key>settings</key>\n\t\t\t<dict>\n'
+                    '\t\t\t\t<key>foreground</key>\n\t\t\t\t<string>%s</string>\n'
+                    '\t\t\t</dict>\n\t\t</dict>\n' % (scope, color))
+        f.write('\t</array>\n</dict>\n</plist>\n')
+
+
+def words(n=2000, seed=0):
+    rnd = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz_'
+    vocabulary = set()
+    while len(vocabulary) < n:
+        vocabulary.add(rnd.choice(letters[:-1]) + ''.join(rnd.choice(letters) for _ in range(rnd.randint(2, 11))))
+    return sorted(vocabulary)
+
+
+def make_text(size, seed=0, block_size=1 << 20):
+    """
+    Return about size characters of synthetic source-like text.
+
+    A block of random lines is generated and then repeated, so even the
+    largest buffers are quick to build while keeping realistic word counts.
+
+    """
+    rnd = random.Random(seed)
+    vocabulary = words(seed=seed)
+    punctuation = [' ', ' ', ' ', ' ', '.', '(', ') ', ', ', ' = ', '; ']
+    lines = []
+    total = 0
+    while total < min(size, block_size):
+        indent = '\t' * rnd.randint(0, 3)
+        line = indent + ''.join(rnd.choice(vocabulary) + rnd.choice(punctuation) for _ in range(rnd.randint(3, 12))).rstrip() + '\n'
+        lines.append(line)
+        total += len(line)
+    block = ''.join(lines)
+    if size <= len(block):
+        return block[:block.rfind('\n', 0, size) + 1] or block
+    return (block * (size // len(block) + 1))[:size].rsplit('\n', 1)[0] + '\n'
+
+
+def prepare():
+    if PACKAGE not in sys.modules:
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [ROOT]
+        sys.modules[PACKAGE] = package
+    write_schemes()
+    if not sublime.windows():
+        sublime.new_window()
+
+
+def load(settings=None):
+    """Import the plugin and run its plugin_loaded(); returns the TextMarker module."""
+    prepare()
+    tm = importlib.import_module(PACKAGE + '.TextMarker')
+    tm.plugin_loaded()
+    if settings:
+        configure(settings)
+    return tm
+
+
+def startup():
+    """
+    Time loading the plugin like Sublime Text does: importing it, running its
+    plugin_loaded(), and the work those deferred until after loading. Only
+    meaningful in a fresh interpreter; returns the timings and the modules
+    loading the plugin imported.
+
+    """
+    prepare()
+    new_view('')
+    before = set(sys.modules)
+    start = clock()
+    tm = importlib.import_module(PACKAGE + '.TextMarker')
+    imported = clock()
+    tm.plugin_loaded()
+    loaded = clock()
+    drain(tm)
+    done = clock()
+    return {
+        'import': imported - start,
+        'plugin_loaded': loaded - imported,
+        'deferred': done - loaded,
+        'modules': sorted(set(sys.modules) - before),
+    }
+
+
+def configure(settings):
+    """Set the user settings of the plugin (replacing the previous ones)."""
+    sublime.load_settings(SETTINGS).set('user', dict(settings))
+
+
+def new_view(text, scheme=JSON_SCHEME):
+    window = sublime.active_window()
+    view = window.new_file(text)
+    view.settings().set('color_scheme', scheme)
+    window.focus_view(view)
+    return view
+
+
+def close_view(tm, view):
+    window = view.window()
+    tm.TextMarkerListener().on_close(view)
+    window._views.remove(view)
+    if window.active is view:
+        window.active = window._views[0] if window._views else None
+
+
+def step():
+    """Run the next due queued timeouts, moving the virtual time forward to them."""
+    due = sublime.next_timeout()
+    return sublime.run_timeouts(due) if due is not None else 0
+
+
+def drain(tm, rounds=None):
+    """
+    Run queued timeouts, either for a number of steps or until none are left.
+
+    Viewport polling reschedules itself forever, so tracked viewports are
+    dropped while draining until empty.
+
+    """
+    if rounds is None:
+        tm.viewports.clear()
+        while step():
+            tm.viewports.clear()
+    else:
+        for _ in range(rounds):
+            step()
+
+
+def run_until(until):
+    """Run all the timeouts due by the virtual time until."""
+    while sublime.run_timeouts(until):
+        pass
+
+
+def reset(tm):
+    """Forget all marks, cached searches and color scheme state."""
+    drain(tm)
+    for window in sublime.windows():
+        for view in window.views():
+            for prefix in ('wh_', 'whl_'):
+                tm.erase_colors(view, prefix=prefix)
+    tm.viewports.clear()
+    tm.live_views.clear()
+    tm.generations.clear()
+    tm.cache.clear()
+    tm.colorizer.color_scheme = None
+    tm.colorizer.colors = {}
+    write_schemes()
+
+
+def word_positions(view, n, region=None, min_length=4):
+    """Return the offsets of n different words of at least min_length characters."""
+    a, b = (0, view.size()) if region is None else (region.begin(), region.end())
+    seen = set()
+    positions = []
+    for m in re.finditer(r'[a-z][a-z_]*', view.substr(sublime.Region(a, b))):
+        word = m.group()
+        if len(word) >= min_length and word not in seen:
+            seen.add(word)
+            positions.append(a + m.start())
+            if len(positions) == n:
+                break
+    return positions
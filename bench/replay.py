@@ -0,0 +1,167 @@
+"""
+Replays a trace recorded by Text Marker (see the "trace" setting) headless,
+against the sublime stand-in in this directory, reporting the latency of
+every event as JSON:
+
+    python bench/replay.py trace-20181010-101010.jsonl --slowest 10 > replay.json
+
+Traces hold no text, so views are filled with synthetic text of the recorded
+sizes, and text changes insert synthetic text of the recorded lengths. The
+plugin settings recorded with the trace are used, unless overridden with
+--settings. Timeouts run on a virtual clock following the recorded times,
+so live_delay collapses bursts of caret moves just like in the editor.
+
+The latency of an event is the time taken by its handler plus whatever it
+set off (searches, painting, index builds) that got to run before the next
+event; "handler" is the time taken by the handler alone.
+
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness  # noqa: E402
+import sublime  # noqa: E402
+
+clock = getattr(time, 'perf_counter', time.time)
+
+KINDS = {'s': 'selection', 'm': 'modified', 'c': 'changes'}
+
+
+class Filler(object):
+    """Synthetic text to fill views and insertions with."""
+
+    def __init__(self):
+        self.block = harness.make_text(1 << 16)
+
+    def __call__(self, n):
+        return (self.block * (n // len(self.block) + 1))[:n]
+
+
+def resize(view, size, filler):
+    # Without text changes (ST3) only the size is known, so grow or shrink the
+    # buffer at its end to match.
+    if view.size() < size:
+        view.replace_text(view.size(), view.size(), filler(size - view.size()))
+    elif view.size() > size:
+        view.replace_text(size, view.size(), '')
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    n = len(timings)
+    return {
+        'count': n,
+        'p50': timings[n * 50 // 100],
+        'p95': timings[min(n - 1, n * 95 // 100)],
+        'p99': timings[min(n - 1, n * 99 // 100)],
+        'max': timings[-1],
+        'total': sum(timings),
+    }
+
+
+def replay(tm, events):
+    filler = Filler()
+    listener = tm.TextMarkerListener()
+    views = {}
+    results = []
+
+    def get_view(vid, size):
+        view = views.get(vid)
+        if view is None:
+            view = views[vid] = harness.new_view(filler(size))
+        view.window().focus_view(view)
+        return view
+
+    for i, event in enumerate(events):
+        kind, t, vid = event[:3]
+        harness.run_until(t)
+        if kind == 'v':
+            get_view(vid, event[3])
+            continue
+        if kind == 'c':
+            view = get_view(vid, 0)
+            for a, b, length in event[3]:
+                view.replace_text(a, b, filler(length))
+            start = clock()
+            tm.update_index(view, [tuple(c) for c in event[3]])
+        elif kind == 'm':
+            view = get_view(vid, event[3])
+            resize(view, event[3], filler)
+            start = clock()
+            listener.on_modified(view)
+        elif kind == 's':
+            view = get_view(vid, event[3])
+            resize(view, event[3], filler)
+            sel = view.sel()
+            sel.clear()
+            for a, b in event[5]:
+                sel.add(sublime.Region(min(a, view.size()), min(b, view.size())))
+            start = clock()
+            listener.on_selection_modified(view)
+        else:
+            continue
+        handler = clock() - start
+        # Whatever the event set off (searches, painting, index builds) counts
+        # towards its latency, as long as it got to run before the next event.
+        if i + 1 < len(events):
+            harness.run_until(events[i + 1][1])
+        else:
+            harness.drain(tm)
+        latency = clock() - start
+        results.append({'i': i, 't': t, 'event': KINDS[kind], 'view': vid, 'size': view.size(), 'handler': handler, 'latency': latency})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a Text Marker trace")
+    parser.add_argument('trace', help="trace file to replay")
+    parser.add_argument('--settings', help="JSON object with settings overriding the recorded ones")
+    parser.add_argument('--slowest', type=int, default=0, help="print the slowest events to stderr")
+    parser.add_argument('--output', help="write the results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    tm = harness.load()
+    trace = importlib.import_module(harness.PACKAGE + '.trace')
+    header, events = trace.load_trace(args.trace)
+    settings = dict(header[4] if header else {})
+    settings.update(json.loads(args.settings) if args.settings else {})
+    settings['trace'] = False
+    harness.configure(settings)
+
+    results = replay(tm, events)
+
+    summary = {}
+    for kind in KINDS.values():
+        timings = [r['latency'] for r in results if r['event'] == kind]
+        if timings:
+            summary[kind] = percentiles(timings)
+
+    report = {
+        'trace': os.path.abspath(args.trace),
+        'settings': settings,
+        'summary': summary,
+        'events': results,
+    }
+
+    for r in sorted(results, key=lambda r: r['latency'], reverse=True)[:args.slowest]:
+        print("#%-6d %10.1f ms  %-9s view %-4d size %-10d %8.3f ms (handler %.3f ms)" % (
+            r['i'], r['t'], r['event'], r['view'], r['size'], r['latency'] * 1000, r['handler'] * 1000), file=sys.stderr)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
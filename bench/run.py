@@ -0,0 +1,317 @@
+"""
+Text Marker benchmarks.
+
+Runs the plugin headless, against the sublime stand-in in this directory,
+over synthetic buffers of several sizes, and prints the results as JSON so
+runs can be saved and compared:
+
+    python bench/run.py --sizes 100K,1M,10M > before.json
+    python bench/run.py --sizes 100K,1M,10M --compare before.json > after.json
+
+Timings are in seconds. This directory isn't loaded by Sublime Text, since
+only the top level modules of a package are plugins.
+
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness  # noqa: E402
+import sublime  # noqa: E402
+
+clock = getattr(time, 'perf_counter', time.time)
+
+DEFAULT_SIZES = '100K,1M,10M,50M,200M'
+
+# Settings for each of the live highlight variants.
+LIVE = {
+    'live': {'live': True, 'live_async': True, 'live_viewport': True, 'live_word_index': True},
+    'live.sync': {'live': True, 'live_async': False, 'live_viewport': True, 'live_word_index': False},
+    'live.full': {'live': True, 'live_async': False, 'live_viewport': False, 'live_word_index': False},
+}
+
+
+def parse_size(size):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    size = size.strip().upper()
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def summary(name, size, timings, **extra):
+    timings = sorted(timings)
+    n = len(timings)
+    result = {
+        'scenario': name,
+        'size': size,
+        'runs': n,
+        'min': timings[0],
+        'median': timings[n // 2] if n % 2 else (timings[n // 2 - 1] + timings[n // 2]) / 2.0,
+        'mean': sum(timings) / n,
+        'p95': timings[min(n - 1, n * 95 // 100)],
+        'max': timings[-1],
+    }
+    result.update(extra)
+    return result
+
+
+def regions_count(view, prefix):
+    return sum(len(v) for k, v in view.regions.items() if k.startswith(prefix))
+
+
+def bench_live(tm, view, name, runs):
+    """
+    Live highlight of the word under the caret, moving to a different word
+    each run; timed until painted when asynchronous, else until the listener
+    returns (which, on large buffers, only paints the first progressive step).
+
+    """
+    harness.reset(tm)
+    harness.configure(LIVE[name])
+    listener = tm.TextMarkerListener()
+    positions = harness.word_positions(view, runs + 1, view.visible_region())
+    timings = []
+    regions = 0
+    for i, pt in enumerate(positions):
+        view.sel().clear()
+        view.sel().add(pt)
+        start = clock()
+        listener.on_selection_modified(view)
+        if LIVE[name]['live_async']:
+            # One round for the search, one for painting its results.
+            harness.drain(tm, rounds=2)
+        elapsed = clock() - start
+        harness.drain(tm)
+        if i:
+            # The first run provisions the color scheme and builds the index.
+            timings.append(elapsed)
+            regions += regions_count(view, 'whl_')
+    return summary(name, view.size(), timings, regions=regions // max(1, len(timings)))
+
+
+def bench_multi_cursor(tm, view, runs, cursors=10):
+    """Mark the words under several carets at once, both until painted and until completely done."""
+    harness.reset(tm)
+    harness.configure({'live': False})
+    positions = harness.word_positions(view, cursors)
+    command = tm.TextMarkerCommand(view)
+    blocking = []
+    complete = []
+    regions = 0
+    for i in range(runs + 1):
+        tm.erase_colors(view)
+        tm.cache.clear()
+        view.sel().clear()
+        for pt in positions:
+            view.sel().add(pt)
+        start = clock()
+        command.run(None)
+        first = clock() - start
+        harness.drain(tm)
+        elapsed = clock() - start
+        if i:
+            blocking.append(first)
+            complete.append(elapsed)
+            regions += regions_count(view, 'wh_')
+    regions //= max(1, runs)
+    return [
+        summary('multi_cursor', view.size(), blocking, cursors=cursors, regions=regions),
+        summary('multi_cursor.complete', view.size(), complete, cursors=cursors, regions=regions),
+    ]
+
+
+def bench_erase(tm, view, runs, colors=8):
+    """Erase the marks of several colors at once."""
+    harness.reset(tm)
+    harness.configure({'live': False})
+    positions = harness.word_positions(view, colors)
+    command = tm.TextMarkerCommand(view)
+    timings = []
+    regions = 0
+    for i in range(runs + 1):
+        for pt in positions:
+            view.sel().clear()
+            view.sel().add(pt)
+            command.run(None)
+            harness.drain(tm)
+        regions = regions_count(view, 'wh_')
+        start = clock()
+        tm.erase_colors(view)
+        elapsed = clock() - start
+        if i:
+            timings.append(elapsed)
+    return summary('erase_colors', view.size(), timings, colors=colors, regions=regions)
+
+
+def bench_scheme(tm, runs, colors=20):
+    """
+    Set up a color scheme and add colors to it, one update at a time, timed
+    until update() returns and until the color scheme is written; then add a
+    burst of colors without waiting in between, which should be written once.
+
+    """
+    results = []
+    variants = [
+        ('scheme.json', harness.JSON_SCHEME, False),
+        ('scheme.json.override', harness.JSON_SCHEME, True),
+        ('scheme.tmtheme', harness.TMTHEME_SCHEME, False),
+    ]
+    for name, scheme, override in variants:
+        setup = []
+        add = []
+        written_runs = []
+        burst = []
+        writes = []
+        size = 0
+        for i in range(runs + 1):
+            harness.configure({'live': False, 'color_scheme_override': override})
+            view = harness.new_view('', scheme)
+            # Configuring provisions the palette, start over from the stock scheme.
+            harness.reset(tm)
+            colorizer = tm.colorizer
+            start = clock()
+            colorizer.setup_color_scheme(view.settings())
+            colorizer.update(view)
+            harness.drain(tm)
+            setup_elapsed = clock() - start
+            timings = []
+            written_timings = []
+            for c in range(colors):
+                color = '#%06x' % (0x102030 + c * 0x010101)
+                start = clock()
+                colorizer.add_color(color)
+                colorizer.update(view)
+                timings.append(clock() - start)
+                harness.drain(tm)
+                written_timings.append(clock() - start)
+            written = tm.stats.counters.get('scheme writes', 0)
+            start = clock()
+            for c in range(colors):
+                colorizer.add_color('#%06x' % (0x201008 + c * 0x010101))
+                colorizer.update(view)
+            harness.drain(tm)
+            burst_elapsed = clock() - start
+            size = os.path.getsize(sublime.packages_path() + colorizer.color_scheme.path)
+            harness.close_view(tm, view)
+            if i:
+                setup.append(setup_elapsed)
+                add.extend(timings)
+                written_runs.extend(written_timings)
+                burst.append(burst_elapsed)
+                writes.append(tm.stats.counters.get('scheme writes', 0) - written)
+        results.append(summary(name + '.setup', size, setup))
+        results.append(summary(name + '.add_color', size, add))
+        results.append(summary(name + '.add_color.written', size, written_runs))
+        results.append(summary(name + '.burst', size, burst, colors=colors, writes=max(writes)))
+    return results
+
+
+STARTUP = '''
+import sys, json
+sys.path.insert(0, %r)
+import harness
+print(json.dumps(harness.startup()))
+'''
+
+
+def bench_startup(runs):
+    """
+    Load the plugin in a fresh interpreter each run, timing the import, its
+    plugin_loaded(), and the work deferred until after loading.
+
+    """
+    code = STARTUP % os.path.dirname(os.path.abspath(__file__))
+    timings = {}
+    modules = []
+    for i in range(runs + 1):
+        output = subprocess.check_output([sys.executable, '-c', code], universal_newlines=True)
+        result = json.loads(output.strip().splitlines()[-1])
+        modules = [m for m in result.pop('modules') if not m.startswith(harness.PACKAGE)]
+        if i:
+            # The first run compiles the modules.
+            for phase, elapsed in result.items():
+                timings.setdefault(phase, []).append(elapsed)
+    return [summary('startup.' + phase, 0, timings[phase], modules=len(modules)) for phase in sorted(timings)]
+
+
+def compare(results, previous):
+    """Print how the median of each benchmark changed since previous, on stderr."""
+    before = dict(((r['scenario'], r['size']), r) for r in previous['results'])
+    for r in results:
+        old = before.get((r['scenario'], r['size']))
+        if old and old['median']:
+            ratio = r['median'] / old['median']
+            print("%-28s %12d %10.3f ms %10.3f ms %+7.1f%%" % (
+                r['scenario'], r['size'], old['median'] * 1000, r['median'] * 1000, (ratio - 1) * 100), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Text Marker benchmarks")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="comma separated buffer sizes (default: %(default)s)")
+    parser.add_argument('--runs', type=int, default=5, help="runs per benchmark (default: %(default)s)")
+    parser.add_argument('--only', default='', help="comma separated scenario prefixes to run")
+    parser.add_argument('--output', help="write the results to this file instead of stdout")
+    parser.add_argument('--compare', help="results of a previous run to compare against")
+    args = parser.parse_args(argv)
+
+    only = [o for o in args.only.split(',') if o]
+
+    def wanted(name):
+        return not only or any(name.startswith(o) for o in only)
+
+    tm = harness.load()
+    results = []
+
+    if wanted('startup'):
+        results.extend(bench_startup(args.runs))
+
+    if wanted('scheme'):
+        results.extend(bench_scheme(tm, args.runs))
+
+    for size in [parse_size(s) for s in args.sizes.split(',') if s]:
+        view = harness.new_view(harness.make_text(size))
+        # Fewer runs on the largest buffers, to keep a full run reasonable.
+        runs = max(1, args.runs if size < 50 << 20 else args.runs // 2)
+        for name in sorted(LIVE):
+            if wanted(name):
+                results.append(bench_live(tm, view, name, runs))
+        if wanted('multi_cursor'):
+            results.extend(bench_multi_cursor(tm, view, runs))
+        if wanted('erase_colors'):
+            results.append(bench_erase(tm, view, runs))
+        harness.reset(tm)
+        harness.close_view(tm, view)
+
+    report = {
+        'plugin': tm.NAME,
+        'version': tm.VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+        'counters': dict((k, v) for k, v in tm.stats.counters.items() if k not in tm.stats.timings),
+    }
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
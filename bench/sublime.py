@@ -0,0 +1,552 @@
+"""
+Headless stand-in for the parts of the Sublime Text API used by Text Marker.
+
+Only meant for running the plugin outside of the editor (benchmarks, trace
+replays); views are plain Python strings searched with the re module, and
+timeouts are queued against a virtual clock until run_timeouts() is called.
+
+"""
+from __future__ import absolute_import
+
+import os
+import re
+import json
+import tempfile
+
+LITERAL = 1
+IGNORECASE = 2
+DRAW_EMPTY = 1
+HIDE_ON_MINIMAP = 2
+DRAW_EMPTY_AS_OVERWRITE = 4
+DRAW_NO_FILL = 32
+DRAW_NO_OUTLINE = 256
+DRAW_SOLID_UNDERLINE = 512
+DRAW_STIPPLED_UNDERLINE = 1024
+DRAW_SQUIGGLY_UNDERLINE = 2048
+PERSISTENT = 16
+HIDDEN = 128
+DRAW_OUTLINED = DRAW_NO_FILL
+
+VERSION = '4126'
+
+# Package name -> directory, for resolving resources outside packages_path().
+packages = {}
+
+root = tempfile.mkdtemp(prefix='text-marker-bench-')
+_packages_path = os.path.join(root, 'Packages')
+_cache_path = os.path.join(root, 'Cache')
+
+_timeouts = []  # (due time, callback) tuples
+now = [0]  # virtual time, in ms
+_settings = {}
+_windows = []
+
+status = []
+
+
+def version():
+    return VERSION
+
+
+def platform():
+    return 'linux'
+
+
+def arch():
+    return 'x64'
+
+
+def packages_path():
+    return _packages_path
+
+
+def installed_packages_path():
+    return os.path.join(root, 'Installed Packages')
+
+
+def cache_path():
+    return _cache_path
+
+
+def status_message(msg):
+    status.append(msg)
+
+
+def error_message(msg):
+    status.append(msg)
+
+
+def set_timeout(callback, delay=0):
+    _timeouts.append((now[0] + (delay or 0), callback))
+
+
+set_timeout_async = set_timeout
+
+
+def run_timeouts(until=None):
+    """
+    Run the callbacks due by until (default: the current virtual time, in ms),
+    advancing the virtual time to it; callbacks queued by those run, the ones
+    they queue wait for the next call.
+
+    """
+    if until is not None:
+        now[0] = max(now[0], until)
+    due = [t for t in _timeouts if t[0] <= now[0]]
+    _timeouts[:] = [t for t in _timeouts if t[0] > now[0]]
+    for when, callback in sorted(due, key=lambda t: t[0]):
+        callback()
+    return len(due)
+
+
+def next_timeout():
+    """Return the virtual time the next queued callback is due at, if any."""
+    return min(t[0] for t in _timeouts) if _timeouts else None
+
+
+def _strip_comments(s):
+    return re.sub(r'("(?:\\.|[^"\\])*")|//[^\n]*|/\*.*?\*/', lambda m: m.group(1) or '', s, flags=re.S)
+
+
+def decode_value(s):
+    s = re.sub(r',(\s*[}\]])', r'\1', _strip_comments(s))
+    return json.loads(s)
+
+
+def encode_value(value, pretty=False):
+    return json.dumps(value, indent='\t' if pretty else None)
+
+
+def _resource_file(name):
+    if not name.startswith('Packages/'):
+        raise IOError("resource not found: %s" % name)
+    path = name[len('Packages/'):]
+    package, _, rest = path.partition('/')
+    if package in packages:
+        return os.path.join(packages[package], rest)
+    return os.path.join(_packages_path, path)
+
+
+def load_resource(name):
+    try:
+        with open(_resource_file(name), 'r') as f:
+            return f.read()
+    except (IOError, OSError):
+        raise IOError("resource not found: %s" % name)
+
+
+def find_resources(pattern):
+    return []
+
+
+class Settings(object):
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+        self.callbacks = {}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+        for callback in list(self.callbacks.values()):
+            callback()
+
+    def has(self, key):
+        return key in self.values
+
+    def erase(self, key):
+        self.values.pop(key, None)
+
+    def add_on_change(self, tag, callback):
+        self.callbacks[tag] = callback
+
+    def clear_on_change(self, tag):
+        self.callbacks.pop(tag, None)
+
+
+def load_settings(name):
+    settings = _settings.get(name)
+    if settings is None:
+        values = {}
+        for package in packages:
+            try:
+                values = decode_value(load_resource('Packages/%s/%s' % (package, name)))
+                break
+            except IOError:
+                pass
+        settings = _settings[name] = Settings(values)
+    return settings
+
+
+def save_settings(name):
+    pass
+
+
+class Region(object):
+    __slots__ = ('a', 'b', 'xpos')
+
+    def __init__(self, a, b=None, xpos=-1):
+        self.a = a
+        self.b = a if b is None else b
+        self.xpos = xpos
+
+    def __len__(self):
+        return self.size()
+
+    def __eq__(self, other):
+        return isinstance(other, Region) and self.a == other.a and self.b == other.b
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.a, self.b))
+
+    def __lt__(self, other):
+        return self.begin() < other.begin()
+
+    def __repr__(self):
+        return '(%d, %d)' % (self.a, self.b)
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return abs(self.b - self.a)
+
+    def empty(self):
+        return self.a == self.b
+
+    def cover(self, other):
+        return Region(min(self.begin(), other.begin()), max(self.end(), other.end()))
+
+    def intersection(self, other):
+        if not self.intersects(other):
+            return Region(0, 0)
+        return Region(max(self.begin(), other.begin()), min(self.end(), other.end()))
+
+    def intersects(self, other):
+        return self.begin() < other.end() and other.begin() < self.end()
+
+    def contains(self, x):
+        if isinstance(x, Region):
+            return self.begin() <= x.begin() and x.end() <= self.end()
+        return self.begin() <= x <= self.end()
+
+
+class Selection(object):
+    def __init__(self):
+        self.regions = []
+
+    def __iter__(self):
+        return iter(list(self.regions))
+
+    def __len__(self):
+        return len(self.regions)
+
+    def __getitem__(self, i):
+        return self.regions[i]
+
+    def clear(self):
+        del self.regions[:]
+
+    def add(self, region):
+        if not isinstance(region, Region):
+            region = Region(region)
+        self.regions.append(region)
+        self.regions.sort()
+
+    def add_all(self, regions):
+        self.regions.extend(regions)
+        self.regions.sort()
+
+    def subtract(self, region):
+        self.regions = [r for r in self.regions if r != region]
+
+
+class View(object):
+    ids = 0
+
+    def __init__(self, window=None, text='', buffer_view=None):
+        View.ids += 1
+        self.view_id = View.ids
+        self._window = window
+        if buffer_view is None:
+            self.shared = {'id': self.view_id, 'text': text, 'change_count': 0}
+        else:
+            self.shared = buffer_view.shared
+        self._settings = Settings({
+            'word_separators': "./\\()\"'-:,.;<>~!@#$%^&*|+=[]{}`~?",
+            'color_scheme': 'Packages/Color Scheme - Default/Monokai.sublime-color-scheme',
+        })
+        self._sel = Selection()
+        self.regions = {}
+        self.statuses = {}
+        self._file_name = None
+        self.viewport = (0, 4000)
+        self.compiled = {}
+
+    @property
+    def text(self):
+        return self.shared['text']
+
+    def id(self):
+        return self.view_id
+
+    def buffer_id(self):
+        return self.shared['id']
+
+    def buffer(self):
+        return Buffer(self.shared['id'])
+
+    def is_valid(self):
+        return True
+
+    def is_loading(self):
+        return False
+
+    def is_primary(self):
+        return self.view_id == self.shared['id']
+
+    def window(self):
+        return self._window
+
+    def file_name(self):
+        return self._file_name
+
+    def settings(self):
+        return self._settings
+
+    def size(self):
+        return len(self.text)
+
+    def change_count(self):
+        return self.shared['change_count']
+
+    def sel(self):
+        return self._sel
+
+    def style(self):
+        return {'background': '#272822', 'foreground': '#f8f8f2'}
+
+    def visible_region(self):
+        a, b = self.viewport
+        return Region(min(a, self.size()), min(b, self.size()))
+
+    def show(self, x, show_surrounds=True):
+        pt = x.begin() if isinstance(x, Region) else x
+        if not self.visible_region().contains(pt):
+            self.scroll_to(pt)
+
+    def scroll_to(self, pt, size=4000):
+        self.viewport = (self.line(pt).begin(), self.line(pt + size).end())
+
+    def substr(self, x):
+        if isinstance(x, Region):
+            return self.text[x.begin():x.end()]
+        return self.text[x:x + 1]
+
+    def word(self, x):
+        if isinstance(x, Region):
+            a, b = x.begin(), x.end()
+        else:
+            a = b = x
+        separators = (self._settings.get('word_separators') or '') + ' \t\n'
+        text = self.text
+        while a > 0 and text[a - 1] not in separators:
+            a -= 1
+        while b < len(text) and text[b] not in separators:
+            b += 1
+        return Region(a, b)
+
+    def line(self, x):
+        if isinstance(x, Region):
+            a, b = x.begin(), x.end()
+        else:
+            a = b = x
+        text = self.text
+        a = text.rfind('\n', 0, a) + 1
+        b = text.find('\n', b)
+        return Region(a, len(text) if b < 0 else b)
+
+    def full_line(self, x):
+        line = self.line(x)
+        return Region(line.a, min(line.b + 1, self.size()))
+
+    def rowcol(self, pt):
+        text = self.text
+        return text.count('\n', 0, pt), pt - (text.rfind('\n', 0, pt) + 1)
+
+    def text_point(self, row, col):
+        pt = 0
+        text = self.text
+        for _ in range(row):
+            pt = text.find('\n', pt) + 1
+            if not pt:
+                return len(text)
+        return min(pt + col, len(text))
+
+    def compile(self, pattern, flags):
+        key = (pattern, flags)
+        regex = self.compiled.get(key)
+        if regex is None:
+            if flags & LITERAL:
+                pattern = re.escape(pattern)
+            regex = self.compiled[key] = re.compile(pattern, re.IGNORECASE if flags & IGNORECASE else 0)
+        return regex
+
+    def find(self, pattern, start_pt, flags=0):
+        m = self.compile(pattern, flags).search(self.text, start_pt)
+        return Region(m.start(), m.end()) if m else Region(-1, -1)
+
+    def find_all(self, pattern, flags=0, fmt=None, extractions=None):
+        regions = []
+        if extractions is None:
+            for m in self.compile(pattern, flags).finditer(self.text):
+                regions.append(Region(m.start(), m.end()))
+        else:
+            template = fmt.replace('$0', '\\g<0>')
+            for m in self.compile(pattern, flags).finditer(self.text):
+                regions.append(Region(m.start(), m.end()))
+                extractions.append(m.group() if template == '\\g<0>' else m.expand(template))
+        return regions
+
+    def find_by_selector(self, selector):
+        # Text after a '#' is taken as a comment, the rest as source; only
+        # "comment" and "source - comment" are told apart.
+        comments = [Region(m.start(), m.end()) for m in re.finditer(r'#[^\n]*', self.text)]
+        if selector.replace(' ', '') == 'comment':
+            return comments
+        regions = []
+        a = 0
+        for comment in comments:
+            if comment.begin() > a:
+                regions.append(Region(a, comment.begin()))
+            a = comment.end()
+        if a < self.size():
+            regions.append(Region(a, self.size()))
+        return regions
+
+    def score_selector(self, pt, selector):
+        return 0
+
+    def scope_name(self, pt):
+        return 'text.plain '
+
+    def add_regions(self, key, regions, scope='', icon='', flags=0):
+        self.regions[key] = list(regions)
+
+    def get_regions(self, key):
+        return list(self.regions.get(key, ()))
+
+    def erase_regions(self, key):
+        self.regions.pop(key, None)
+
+    def set_status(self, key, value):
+        self.statuses[key] = value
+
+    def erase_status(self, key):
+        self.statuses.pop(key, None)
+
+    def run_command(self, cmd, args=None):
+        if cmd == 'append':
+            self.replace_text(self.size(), self.size(), args['characters'])
+
+    def replace_text(self, a, b, string):
+        """Replace the text between a and b, like an edit would."""
+        shared = self.shared
+        shared['text'] = shared['text'][:a] + string + shared['text'][b:]
+        shared['change_count'] += 1
+
+
+class Buffer(object):
+    def __init__(self, buffer_id):
+        self.buffer_id = buffer_id
+
+    def id(self):
+        return self.buffer_id
+
+    def views(self):
+        return [v for w in _windows for v in w.views() if v.buffer_id() == self.buffer_id]
+
+    def primary_view(self):
+        views = self.views()
+        return views[0] if views else None
+
+
+class Window(object):
+    ids = 0
+
+    def __init__(self):
+        Window.ids += 1
+        self.window_id = Window.ids
+        self._views = []
+        self.active = None
+        self.panels = {}
+        self.folder_list = []
+
+    def id(self):
+        return self.window_id
+
+    def views(self):
+        return list(self._views)
+
+    def active_view(self):
+        return self.active
+
+    def focus_view(self, view):
+        self.active = view
+
+    def num_groups(self):
+        return 1
+
+    def active_view_in_group(self, group):
+        return self.active
+
+    def folders(self):
+        return list(self.folder_list)
+
+    def project_data(self):
+        return {'folders': [{'path': path} for path in self.folder_list]}
+
+    def new_file(self, text=''):
+        view = View(self, text)
+        self._views.append(view)
+        if self.active is None:
+            self.active = view
+        return view
+
+    def clone(self, view):
+        clone = View(self, buffer_view=view)
+        self._views.append(clone)
+        return clone
+
+    def create_output_panel(self, name):
+        panel = self.panels[name] = View(self)
+        return panel
+
+    get_output_panel = create_output_panel
+
+    def show_input_panel(self, caption, initial_text, on_done, on_change, on_cancel):
+        pass
+
+    def run_command(self, cmd, args=None):
+        pass
+
+
+def windows():
+    return list(_windows)
+
+
+def active_window():
+    return _windows[0] if _windows else None
+
+
+def new_window():
+    window = Window()
+    _windows.append(window)
+    return window
@@ -0,0 +1,30 @@
+"""Headless stand-in for the sublime_plugin module, see sublime.py."""
+from __future__ import absolute_import
+
+
+class EventListener(object):
+    pass
+
+
+class ViewEventListener(object):
+    def __init__(self, view):
+        self.view = view
+
+
+class TextChangeListener(object):
+    def __init__(self):
+        self.buffer = None
+
+
+class ApplicationCommand(object):
+    pass
+
+
+class WindowCommand(object):
+    def __init__(self, window):
+        self.window = window
+
+
+class TextCommand(object):
+    def __init__(self, view):
+        self.view = view
@@ -5,16 +5,21 @@ import re
 import sys
 import json
 import errno
-import plistlib
-import datetime
+import colorsys
+import threading
+from collections import OrderedDict
 
 import sublime
 
-from .colors import names_to_hex, xterm_to_hex, xterm8_to_hex, xterm8b_to_hex, xterm8f_to_hex
+from .stats import stats, timed
 
 DEFAULT_COLOR_SCHEME = 'Monokai.sublime-color-scheme'
+WRITE_DELAY = 50  # ms, writes requested within this time land on disk together
 
-all_names_to_hex = dict(names_to_hex, **xterm_to_hex)
+set_timeout_async = getattr(sublime, 'set_timeout_async', sublime.set_timeout)
+replace_file = getattr(os, 'replace', None)
+
+all_names_to_hex = None  # loaded by get_names_to_hex()
 
 
 class Log(object):
@@ -32,15 +37,43 @@ class Log(object):
 log = Log()
 
 
-if sys.version_info[0] == 3:
-    if not hasattr(plistlib, 'loads'):
-        plistlib.loads = lambda data: plistlib.readPlistFromBytes(data)
-        plistlib.dumps = lambda value: plistlib.writePlistToBytes(value)
-else:
-    plistlib.loads = lambda data: plistlib.readPlistFromString(data)
-    plistlib.dumps = lambda value: plistlib.writePlistToString(value)
+def get_names_to_hex():
+    """Return the table of color names (CSS and xterm), built the first time it's needed."""
+    global all_names_to_hex
+    if all_names_to_hex is None:
+        from .colors import names_to_hex, xterm_to_hex
+        all_names_to_hex = dict(names_to_hex, **xterm_to_hex)
+    return all_names_to_hex
+
+
+def get_plistlib():
+    # plistlib (and the XML parser it pulls in) is only needed to round trip
+    # tmThemes whose rules couldn't be spliced in, so it's imported on demand.
+    import plistlib
+    if sys.version_info[0] == 3:
+        if not hasattr(plistlib, 'loads'):
+            plistlib.loads = lambda data: plistlib.readPlistFromBytes(data)
+            plistlib.dumps = lambda value: plistlib.writePlistToBytes(value)
+    elif not hasattr(plistlib, 'loads'):
+        plistlib.loads = lambda data: plistlib.readPlistFromString(data)
+        plistlib.dumps = lambda value: plistlib.writePlistToString(value)
+    return plistlib
+
+
+class Memo(OrderedDict):
+    """Dictionary holding at most max_size items, dropping the oldest ones."""
+
+    def __init__(self, max_size=1024):
+        OrderedDict.__init__(self)
+        self.max_size = max_size
+
+    def __setitem__(self, key, value):
+        OrderedDict.__setitem__(self, key, value)
+        while len(self) > self.max_size:
+            self.popitem(last=False)
 
 
+@timed('write_package')
 def write_package(path, content):
     rf = sublime.packages_path() + path
     try:
@@ -48,8 +81,87 @@ def write_package(path, content):
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
-    with open(rf, 'w') as f:
-        f.write(content)
+    # Write to a temporary file and move it over the old one, so a crash
+    # halfway through never leaves a truncated color scheme behind.
+    tmp = '%s.%d.tmp' % (rf, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            f.write(content)
+        if replace_file:
+            replace_file(tmp, rf)
+        else:
+            if os.name == 'nt' and os.path.exists(rf):
+                os.remove(rf)
+            os.rename(tmp, rf)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class PackageWriter(object):
+    """
+    Writes package files off the UI thread.
+
+    Writes requested while others are still pending are coalesced so only the
+    latest content of each file gets written, that way marking several terms
+    with new colors in a row makes Sublime Text reload the color scheme once.
+
+    """
+
+    def __init__(self):
+        self.pending = OrderedDict()  # path -> (content, callbacks)
+        self.busy = set()  # paths pending or being written
+        self.scheduled = False
+        self.lock = threading.Lock()
+        self.writing = threading.Lock()
+
+    def write(self, path, content, callback=None):
+        """
+        Queue content to be written to path. callback, if given, is called
+        from the writer thread with the error, if any, once it's done.
+
+        """
+        with self.lock:
+            old, callbacks = self.pending.pop(path, (None, []))
+            if old is not None:
+                stats.count('scheme writes coalesced')
+            if callback:
+                callbacks.append(callback)
+            self.pending[path] = (content, callbacks)
+            self.busy.add(path)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        set_timeout_async(self.flush, WRITE_DELAY)
+
+    def writing_to(self, path):
+        with self.lock:
+            return path in self.busy
+
+    def flush(self):
+        """Write all pending files now."""
+        # Writes are serialized so the last content requested is the one left.
+        with self.writing:
+            with self.lock:
+                pending, self.pending = self.pending, OrderedDict()
+                self.scheduled = False
+            for path, (content, callbacks) in pending.items():
+                error = None
+                try:
+                    write_package(path, content)
+                    stats.count('scheme writes')
+                except Exception as e:
+                    log.error("Couldn't write %s: %r" % (path, e))
+                    error = e
+                for callback in callbacks:
+                    callback(error)
+                with self.lock:
+                    if path not in self.pending:
+                        self.busy.discard(path)
+
+
+writer = PackageWriter()
 
 
 def read_package(path):
@@ -63,20 +175,155 @@ def read_package(path):
     return res
 
 
+def color_scheme_path(settings):
+    path = settings.get('color_scheme') or DEFAULT_COLOR_SCHEME
+    if not path.startswith('Packages/'):
+        path = 'Packages/Color Scheme - Default/' + path
+    # Remove "Packages" part from name
+    return path[8:]
+
+
+class ColorSchemeModel(object):
+    """
+    In-memory model of a color scheme.
+
+    Knows which colorizer rules are already in the content and where new ones
+    go, so adding rules is a matter of splicing them in at a known offset.
+
+    """
+    plist_rule = (
+        '\t\t<dict>\n'
+        '\t\t\t<key>scope</key>\n'
+        '\t\t\t<string>%(scope)s</string>\n'
+        '\t\t\t<key>settings</key>\n'
+        '\t\t\t<dict>\n'
+        '\t\t\t\t<key>foreground</key>\n'
+        '\t\t\t\t<string>%(foreground)s</string>\n'
+        '\t\t\t\t<key>background</key>\n'
+        '\t\t\t\t<string>%(background)s</string>\n'
+        '\t\t\t</dict>\n'
+        '\t\t</dict>\n'
+    )
+
+    def __init__(self, content, prefix):
+        self.content = content
+        self.prefix = prefix
+        self.colors = set("#%s" % c.upper() for c in re.findall(r'\b%s([a-fA-F0-9]{8})\b' % prefix, content))
+        self.has_gutter = bool(re.search(r'\b%sgutter\b' % prefix, content))
+        self.format = None
+        self.offset = None
+        # For sublime-color-scheme
+        m = re.search(r'([\t ]*)"rules":\s*\[[\r\n]*', content)
+        # For sublime-color-scheme without rules yet (say, an override of
+        # only globals or variables), insert() adds them after the brace.
+        brace = re.match(r'(?:\s|//[^\n]*|/\*.*?\*/)*\{', content, re.S)
+        if m:
+            self.format = 'sublime-color-scheme'
+            self.indent = m.group(1)
+            self.offset = m.end()
+        elif brace:
+            self.format = 'sublime-color-scheme'
+            self.indent = '\t'
+            self.brace = brace.end()
+        # for tmTheme
+        elif re.match(r'\s*<(?:\?xml|!DOCTYPE|plist)\b', content):
+            self.format = 'tmTheme'
+            self.offset = self.settings_end(content)
+
+    def settings_end(self, content):
+        """Return the offset of the closing tag of the top-level settings array."""
+        m = re.search(r'<key>\s*settings\s*</key>\s*<array>', content)
+        if not m:
+            return None
+        depth = 1
+        for t in re.compile(r'<(/?)array\s*>').finditer(content, m.end()):
+            depth += -1 if t.group(1) else 1
+            if not depth:
+                return t.start()
+
+    def insert(self, rules):
+        """Add rules to the content and return the new content."""
+        content = self.content
+        if self.format == 'sublime-color-scheme':
+            if self.offset is None:
+                brace = self.brace
+                head = content[:brace] + '\n\t"rules": [\n'
+                tail = '\t]\n' if re.match(r'\s*\}', content[brace:]) else '\t],\n'
+                content = head + tail + content[brace:]
+                self.offset = len(head)
+            json_rules = json.dumps({"rules": rules}, indent=self.indent)
+            json_rules = '\n'.join(map(str.rstrip, json_rules.split('\n')[2:-2])) + ',\n'
+            content = content[:self.offset] + json_rules + content[self.offset:]
+        elif self.format == 'tmTheme' and self.offset is not None:
+            plist_rules = ''.join(self.plist_rule % r for r in rules)
+            content = content[:self.offset] + plist_rules + content[self.offset:]
+            self.offset += len(plist_rules)
+        elif self.format == 'tmTheme':
+            # Couldn't find where the rules go, do a full round trip instead.
+            plistlib = get_plistlib()
+            plist_content = plistlib.loads(content.encode('utf-8'))
+            plist_content['settings'].extend({
+                "scope": r['scope'],
+                "settings": {
+                    "foreground": r['foreground'],
+                    "background": r['background'],
+                }
+            } for r in rules)
+            content = plistlib.dumps(plist_content).decode('utf-8')
+            self.offset = self.settings_end(content)
+        else:
+            raise ValueError("Schema format not recognized")
+        for r in rules:
+            if r['scope'] == '%sgutter' % self.prefix:
+                self.has_gutter = True
+            else:
+                self.colors.add('#' + r['scope'][len(self.prefix):])
+        self.content = content
+        return content
+
+
 class ColorScheme(object):
     backup_ext = ".chback"
 
     def __init__(self, settings):
-        path = settings.get('color_scheme') or DEFAULT_COLOR_SCHEME
-        if not path.startswith('Packages/'):
-            path = 'Packages/Color Scheme - Default/' + path
-        self.path = path[8:]
-        self.time = datetime.datetime.now()
-
-    def hash(self):
-        if not hasattr(self, '_hash'):
-            self._hash = hash(self.content())
-        return self._hash
+        self.scheme_path = self.path = color_scheme_path(settings)
+        self.stale = False
+        self._stat = self.stat()
+
+    def stat(self):
+        """Return the (mtime, size, inode) of the file, or None if it doesn't exist unpacked."""
+        try:
+            st = os.stat(sublime.packages_path() + self.path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def changed(self):
+        """Return whether the file was changed by someone else since it was loaded or written."""
+        return not writer.writing_to(self.path) and self.stat() != self._stat
+
+    def write(self, content, callback=None):
+        """
+        Queue content to be written in the background; callback is called
+        from the writer thread with the error, if any, once it's on disk.
+
+        """
+        def written(error):
+            if error is None:
+                self._stat = self.stat()
+            if callback:
+                callback(error)
+        self._content = content
+        writer.write(self.path, content, written)
+
+    def reload(self):
+        self.__dict__.pop('_content', None)
+        self.__dict__.pop('_model', None)
+
+    def model(self):
+        if not hasattr(self, '_model'):
+            self._model = ColorSchemeModel(self.content(), SchemaColorizer.prefix)
+        return self._model
 
     def restore(self):
         # Remove "Packages" part from name
@@ -105,36 +352,134 @@ class ColorScheme(object):
         return self._content
 
 
+class ColorSchemeOverride(ColorScheme):
+    """
+    User-level override of a color scheme, holding only the colorizer rules.
+
+    Sublime Text (build 3150 and later) merges Packages/User/<name>.sublime-color-scheme
+    into the color scheme with the same name, so adding a color only needs to
+    write this small file instead of the whole color scheme.
+
+    """
+    template = '{\n\t"rules": [\n\t]\n}\n'
+
+    def __init__(self, settings):
+        ColorScheme.__init__(self, settings)
+        name = os.path.splitext(os.path.basename(self.path))[0]
+        self.path = '/User/%s.sublime-color-scheme' % name
+        self._stat = self.stat()
+
+    def restore(self):
+        rf = sublime.packages_path() + self.path
+        if not os.path.exists(rf):
+            log.debug("No override :(")
+            return False
+        log.debug("Starting restore override: " + self.path)
+        data = sublime.decode_value(read_package(self.path))
+        rules = [r for r in data.get('rules', []) if not r.get('scope', '').startswith(SchemaColorizer.prefix)]
+        if rules or set(data) - set(['rules']):
+            # Keep any customizations of the user in there.
+            data['rules'] = rules
+            write_package(self.path, json.dumps(data, indent='\t'))
+        else:
+            os.remove(rf)
+        log.debug("Restore done.")
+        return True
+
+    def content(self):
+        if not hasattr(self, '_content'):
+            rf = sublime.packages_path() + self.path
+            if os.path.exists(rf):
+                self._content = read_package(self.path)
+            else:
+                self._content = self.template
+        return self._content
+
+
 class SchemaColorizer(object):
     prefix = "col_"
 
     colors = {}
+    palette = ()
+    override = False
     color_scheme = None
     need_update = False
 
+    # Memoized results of normalize() and get_inv_col()
+    normalized = Memo()
+    inverted = Memo()
+
     def normalize(self, col):
         if col:
-            col = all_names_to_hex.get(col.lower(), col.upper())
-            if col.startswith('0X'):
-                col = '#' + col[2:]
             try:
-                if col[0] != '#':
+                return self.normalized[col]
+            except KeyError:
+                pass
+            normalized = self.normalized[col] = self.parse_color(col)
+            return normalized
+
+    def parse_color(self, col):
+        lower = col.strip().lower()
+        try:
+            if lower.startswith('xterm:'):
+                from .colors import xterm_to_hex
+                return '#%02X%02X%02X%02X' % tuple(int(xterm_to_hex[lower[6:].strip()][i:i + 2], 16) for i in (1, 3, 5, 7))
+
+            m = re.match(r'(rgba?|hsla?)\((.*)\)$', lower)
+            if m:
+                args = [v for v in re.split(r'[\s,/]+', m.group(2).strip()) if v]
+                if len(args) not in (3, 4):
                     raise ValueError
-                if len(col) == 4:
-                    col = '#' + col[1] * 2 + col[2] * 2 + col[3] * 2 + 'FF'
-                elif len(col) == 5:
-                    col = '#' + col[1] * 2 + col[2] * 2 + col[3] * 2 + col[4] * 2
-                elif len(col) == 7:
-                    col += 'FF'
-                r = int(col[1:3], 16)
-                g = int(col[3:5], 16)
-                b = int(col[5:7], 16)
-                a = int(col[7:9], 16) or 1  # alpha == 0 doesn't apply alpha in Sublime
+                if m.group(1).startswith('rgb'):
+                    r, g, b = (self.parse_component(v, 255) for v in args[:3])
+                else:
+                    h = float(args[0].rstrip('deg')) % 360 / 360
+                    s = self.parse_component(args[1], 1, percent=True)
+                    l = self.parse_component(args[2], 1, percent=True)
+                    r, g, b = (int(round(c * 255)) for c in colorsys.hls_to_rgb(h, l, s))
+                a = self.parse_component(args[3], 1) if len(args) == 4 else 1.0
+                a = int(round(a * 255)) or 1  # alpha == 0 doesn't apply alpha in Sublime
                 return '#%02X%02X%02X%02X' % (r, g, b, a)
-            except Exception:
-                log.debug("Invalid color: %r" % col)
+
+            if lower.startswith(('#', '0x')):
+                col = col.upper()
+            else:
+                col = get_names_to_hex().get(lower, col.upper())
+            if col.startswith('0X'):
+                col = '#' + col[2:]
+            if col[0] != '#':
+                raise ValueError
+            if len(col) == 4:
+                col = '#' + col[1] * 2 + col[2] * 2 + col[3] * 2 + 'FF'
+            elif len(col) == 5:
+                col = '#' + col[1] * 2 + col[2] * 2 + col[3] * 2 + col[4] * 2
+            elif len(col) == 7:
+                col += 'FF'
+            r = int(col[1:3], 16)
+            g = int(col[3:5], 16)
+            b = int(col[5:7], 16)
+            a = int(col[7:9], 16) or 1  # alpha == 0 doesn't apply alpha in Sublime
+            return '#%02X%02X%02X%02X' % (r, g, b, a)
+        except Exception:
+            log.debug("Invalid color: %r" % col)
+
+    def parse_component(self, value, scale, percent=False):
+        if value.endswith('%'):
+            value = float(value[:-1]) / 100 * scale
+        elif percent:
+            value = float(value) / 100 * scale
+        else:
+            value = float(value)
+        value = max(0, min(scale, value))
+        return int(round(value)) if scale == 255 else value
 
     def get_inv_col(self, bg_col, col):
+        key = (bg_col, col)
+        try:
+            return self.inverted[key]
+        except KeyError:
+            pass
+
         br = int(bg_col[1:3], 16)
         bg = int(bg_col[3:5], 16)
         bb = int(bg_col[5:7], 16)
@@ -152,18 +497,24 @@ class SchemaColorizer(object):
         # Y709 = 0.2126 * r + 0.7152 * g + 0.0722 * b
         Y601 = ((r * 299) + (g * 587) + (b * 114)) / 1000
 
-        v = Y601
+        v = int(Y601)
 
         if v >= 128:
             v -= 128
         else:
             v += 128
 
-        return '#%sFF' % (('%02X' % v) * 3)
+        inv_col = self.inverted[key] = '#%sFF' % (('%02X' % v) * 3)
+        return inv_col
 
     def region_name(self, s):
         return self.prefix + s[1:]
 
+    def region_color(self, name):
+        if name.startswith(self.prefix):
+            return '#' + name[len(self.prefix):]
+        return name
+
     def add_color(self, col):
         col = self.normalize(col)
         if not col:
@@ -173,6 +524,10 @@ class SchemaColorizer(object):
             self.need_update = True
         return self.colors[col]
 
+    def add_colors(self, cols):
+        for col in cols:
+            self.add_color(col)
+
     def current_views(self):
         for window in sublime.windows():
             for view in window.views():
@@ -185,25 +540,29 @@ class SchemaColorizer(object):
             return (bg_col + 'FF')[:9].upper()
         return '#333333FF'
 
+    @timed('colorizer.update')
     def update(self, view):
+        """Add the rules of new colors to the color scheme, written in the background."""
         if not self.need_update:
             return
         self.need_update = False
 
-        content = self.color_scheme.content()
-        current_colors = set("#%s" % c.upper() for c in re.findall(r'\b%s([a-fA-F0-9]{8})\b' % self.prefix, content))
+        if self.color_scheme.changed():
+            # Don't clobber changes made to the file by someone else.
+            self.color_scheme.reload()
+        model = self.color_scheme.model()
 
         bg_col = self.get_background_col(view)
 
         rules = []
-        if not re.search(r'\b%sgutter\b' % self.prefix, content):
+        if not model.has_gutter:
             rules.append({
                 "scope": "%sgutter" % self.prefix,
                 "background": "#000000",
                 "foreground": "#ffffff",
             })
         for col, name in self.colors.items():
-            if col not in current_colors:
+            if col not in model.colors:
                 fg_col = self.get_inv_col(bg_col, col)
                 rules.append({
                     "scope": name,
@@ -211,58 +570,67 @@ class SchemaColorizer(object):
                     "foreground": fg_col,
                 })
 
-        if rules:
-            try:
-                # For sublime-color-scheme
-                m = re.search(r'([\t ]*)"rules":\s*\[[\r\n]*', content)
-                if m:
-                    json_rules = json.dumps({"rules": rules}, indent=m.group(1))
-                    json_rules = '\n'.join(map(str.rstrip, json_rules.split('\n')[2:-2])) + ',\n'
-                    content = content[:m.end()] + json_rules + content[m.end():]
-                    write_package(self.color_scheme.path, content)
-                    log.debug("Updated sublime-color-scheme")
-                    return
-
-                # for tmTheme
-                if re.match(r'\s*<(?:\?xml|!DOCTYPE|plist)\b', content):
-                    plist_content = plistlib.loads(content.encode('utf-8'))
-                    plist_content['settings'].extend({
-                        "scope": r['scope'],
-                        "settings": {
-                            "foreground": r['foreground'],
-                            "background": r['background'],
-                        }
-                    } for r in rules)
-                    content = plistlib.dumps(plist_content).decode('utf-8')
-                    write_package(self.color_scheme.path, content)
-                    log.debug("Updated tmTheme")
-                    return
-
-                log.error("Not Updated: Schema format not recognized")
-            except Exception as e:
-                import traceback; traceback.print_exc();
-                log.error("Not Updated: %r" % e)
+        if not rules:
+            return
+
+        color_scheme = self.color_scheme
+
+        def written(error):
+            if error is None:
+                stats.count('scheme rules written', len(rules))
+                log.debug("Updated %s" % model.format)
+            else:
+                sublime.set_timeout(lambda: failed(error), 0)
+
+        def failed(error):
+            # Start over from whatever is on disk the next time around.
+            log.error("Not Updated: %r" % error)
+            color_scheme.reload()
+            if color_scheme is self.color_scheme:
+                self.need_update = True
+
+        try:
+            content = model.insert(rules)
+        except Exception as e:
+            import traceback; traceback.print_exc();
+            log.error("Not Updated: %r" % e)
+            self.need_update = True
+            return
+        color_scheme.write(content, written)
 
     def clear(self):
         self.colors = {}
 
+    @timed('colorizer.setup_color_scheme')
     def setup_color_scheme(self, settings):
-        color_scheme = ColorScheme(settings)
-        if self.color_scheme and self.color_scheme.path == color_scheme.path:
-            if self.color_scheme.time + datetime.timedelta(seconds=1) > color_scheme.time:
-                return
-            if self.color_scheme.hash() == color_scheme.hash():
-                self.color_scheme.time = color_scheme.time
-                return
+        # This is called for every mark, so when the color scheme didn't change
+        # it must not touch the disk; external changes to the file are picked
+        # up by check_color_scheme() instead.
+        cls = ColorSchemeOverride if self.override else ColorScheme
+        if (self.color_scheme and type(self.color_scheme) is cls and not self.color_scheme.stale and
+                self.color_scheme.scheme_path == color_scheme_path(settings)):
+            return
+        color_scheme = cls(settings)
         log.debug("Color scheme %s setup" % color_scheme.path)
         self.color_scheme = color_scheme
-        content = self.color_scheme.content()
-        self.colors = dict(("#%s" % c, "%s%s" % (self.prefix, c)) for c in re.findall(r'\b%s([a-fA-F0-9]{8})\b' % self.prefix, content))
+        self.colors = dict((c, self.region_name(c)) for c in self.color_scheme.model().colors)
+        # Provision the whole palette at once, so it all gets written to the
+        # scheme in a single update instead of one per new color.
+        self.add_colors(self.palette)
+
+    def check_color_scheme(self):
+        """Flag the color scheme for reloading if its file changed on disk."""
+        if self.color_scheme and self.color_scheme.changed():
+            log.debug("Color scheme %s changed" % self.color_scheme.path)
+            self.color_scheme.stale = True
 
     def restore_color_scheme(self):
         # do not support empty color scheme
         if not self.color_scheme:
             log.error("Empty scheme, can't restore")
             return
+        # Pending writes would undo the restore.
+        writer.flush()
         if self.color_scheme.restore():
             self.colors = {}
+            self.color_scheme = None
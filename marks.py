@@ -0,0 +1,229 @@
+from __future__ import absolute_import
+
+import os
+import json
+import threading
+from bisect import bisect_left, bisect_right
+
+import sublime
+
+SAVE_DELAY = 1000  # ms
+
+set_timeout_async = getattr(sublime, 'set_timeout_async', sublime.set_timeout)
+
+
+class MarkedRegions(object):
+    """Regions of a single color, sorted by start for bisecting."""
+
+    def __init__(self, change_count, regions):
+        self.change_count = change_count
+        self.regions = sorted(regions, key=lambda r: r.begin())
+        self.starts = [r.begin() for r in self.regions]
+        # Running maximum of the region ends, so overlapping regions that start
+        # earlier but reach further can still be found without a full scan.
+        self.max_ends = []
+        max_end = -1
+        for region in self.regions:
+            max_end = max(max_end, region.end())
+            self.max_ends.append(max_end)
+
+    def contains(self, sel):
+        begin, end = sel.begin(), sel.end()
+        i = bisect_right(self.starts, begin) - 1
+        while i >= 0 and self.max_ends[i] >= end:
+            if self.regions[i].end() >= end:
+                return True
+            i -= 1
+        return False
+
+    def next(self, pt):
+        """Return the first region starting after pt, if any."""
+        i = bisect_right(self.starts, pt)
+        if i < len(self.regions):
+            return self.regions[i]
+
+    def previous(self, pt):
+        """Return the last region starting before pt, if any."""
+        i = bisect_left(self.starts, pt)
+        if i:
+            return self.regions[i - 1]
+
+    def first(self):
+        return self.regions[0] if self.regions else None
+
+    def last(self):
+        return self.regions[-1] if self.regions else None
+
+
+class Marks(object):
+    """Per-view index of the marked regions of each color."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.colors = {}
+        self.terms = {}  # color scope name -> patterns marked in that color
+        self.selectors = {}  # color scope name -> selector the marks are limited to
+
+    def set(self, view, color_scope_name, regions):
+        if regions:
+            self.colors[color_scope_name] = MarkedRegions(view.change_count(), regions)
+        else:
+            self.colors.pop(color_scope_name, None)
+
+    def load(self, view, color_scope_name):
+        self.set(view, color_scope_name, view.get_regions(self.prefix + color_scope_name))
+
+    def remember(self, color_scope_name, patterns, selector=None):
+        if patterns:
+            self.terms[color_scope_name] = list(patterns)
+        else:
+            self.terms.pop(color_scope_name, None)
+        if patterns and selector:
+            self.selectors[color_scope_name] = selector
+        else:
+            self.selectors.pop(color_scope_name, None)
+
+    def erase(self, color_scope_name):
+        self.colors.pop(color_scope_name, None)
+        self.terms.pop(color_scope_name, None)
+        self.selectors.pop(color_scope_name, None)
+
+    def scopes(self):
+        return list(self.colors)
+
+    def refresh(self, view):
+        """Reload the regions of the colors that changed since they were indexed."""
+        change_count = view.change_count()
+        for color_scope_name in list(self.colors):
+            if self.colors[color_scope_name].change_count != change_count:
+                # Edits move marks around; pick up their current positions.
+                self.load(view, color_scope_name)
+
+    def find(self, view, sel):
+        """Return the color scope name of the mark containing sel, if any."""
+        self.refresh(view)
+        for color_scope_name, marked in self.colors.items():
+            if marked.contains(sel):
+                return color_scope_name
+
+    def navigate(self, view, pt, forward=True, color_scope_name=None):
+        """
+        Return the mark closest to pt, after it if forward or else before it,
+        optionally only of the color color_scope_name; None if there are none.
+
+        """
+        self.refresh(view)
+        if color_scope_name is None:
+            colors = self.colors.values()
+        else:
+            colors = [self.colors[color_scope_name]] if color_scope_name in self.colors else []
+        found = [r for r in ((m.next(pt) if forward else m.previous(pt)) for m in colors) if r is not None]
+        if not found:
+            return None
+        return min(found, key=lambda r: r.begin()) if forward else max(found, key=lambda r: r.begin())
+
+    def bounds(self, view, color_scope_name=None):
+        """Return the first and last marks, optionally only of the color color_scope_name."""
+        self.refresh(view)
+        colors = [m for c, m in self.colors.items() if color_scope_name in (None, c) and m.regions]
+        if not colors:
+            return None, None
+        return min((m.first() for m in colors), key=lambda r: r.begin()), max((m.last() for m in colors), key=lambda r: r.begin())
+
+
+indexes = {}
+
+
+def get_marks(view, prefix='wh_', color_scope_names=()):
+    """
+    Return the marks index of view for prefix.
+
+    The first time a view is seen, the index is seeded by loading the regions
+    of each of color_scope_names already in the view.
+
+    """
+    key = (view.id(), prefix)
+    marks = indexes.get(key)
+    if marks is None:
+        marks = indexes[key] = Marks(prefix)
+        for color_scope_name in color_scope_names:
+            marks.load(view, color_scope_name)
+    return marks
+
+
+def clear_marks(view, prefix='wh_'):
+    indexes[(view.id(), prefix)] = Marks(prefix)
+
+
+def drop_marks(view):
+    for key in [k for k in indexes if k[0] == view.id()]:
+        del indexes[key]
+
+
+class MarkStore(object):
+    """
+    On-disk store of the terms marked in each file.
+
+    Terms are kept per file name as compact [color scope name, string, mode]
+    lists, with mode being either 'word' or 'text', and the selector the term
+    is limited to appended when there's one. Loading happens on first
+    use and saving is debounced and done off the UI thread.
+
+    """
+
+    def __init__(self):
+        self.files = None
+        self.pending = False
+        self.lock = threading.Lock()
+
+    def path(self):
+        cache_path = getattr(sublime, 'cache_path', None)
+        if cache_path:
+            return os.path.join(cache_path(), 'Text Marker', 'marks.json')
+        return os.path.join(sublime.packages_path(), 'User', 'Text Marker.marks.json')
+
+    def load(self):
+        if self.files is None:
+            try:
+                with open(self.path(), 'r') as f:
+                    self.files = json.load(f)
+            except (IOError, OSError, ValueError):
+                self.files = {}
+        return self.files
+
+    def get(self, file_name):
+        return self.load().get(file_name)
+
+    def set(self, file_name, terms):
+        files = self.load()
+        with self.lock:
+            if terms:
+                files[file_name] = terms
+            elif files.pop(file_name, None) is None:
+                return
+            if self.pending:
+                return
+            self.pending = True
+        set_timeout_async(self.save, SAVE_DELAY)
+
+    def save(self):
+        # Saving runs off the UI thread, so it works on a snapshot of the
+        # files, which set() keeps changing.
+        with self.lock:
+            self.pending = False
+            files = dict(self.files)
+        path = self.path()
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(files, f, separators=(',', ':'))
+            getattr(os, 'replace', os.rename)(tmp, path)
+        except (IOError, OSError):
+            pass
+
+
+store = MarkStore()
@@ -0,0 +1,116 @@
+from __future__ import absolute_import
+
+import os
+import re
+import mmap
+import fnmatch
+
+MAX_MATCHES = 1000  # lines reported per file
+MAX_LINE = 200  # characters of each line reported
+COUNT_CHUNK = 1 << 20  # bytes scanned at once when counting lines
+BINARY_SNIFF = 8192  # bytes looked at for a NUL to tell binary files apart
+
+
+def excluded(name, path, patterns):
+    for pattern in patterns:
+        if pattern.endswith('/'):
+            pattern = pattern[:-1]
+        if fnmatch.fnmatch(name, pattern) or ('/' in pattern and fnmatch.fnmatch(path, '*/' + pattern.lstrip('/'))):
+            return True
+    return False
+
+
+def walk(folders, folder_exclude_patterns=(), file_exclude_patterns=()):
+    """
+    Yield the paths of the files in folders, skipping excluded folders and files.
+
+    folders is a list of (path, folder exclude patterns, file exclude patterns)
+    tuples, with the patterns of each folder added to the given ones.
+
+    """
+    seen = set()
+    for folder, folder_excludes, file_excludes in folders:
+        folder_excludes = list(folder_exclude_patterns) + list(folder_excludes)
+        file_excludes = list(file_exclude_patterns) + list(file_excludes)
+        for root, dirs, files in os.walk(folder):
+            root_path = root.replace(os.sep, '/')
+            dirs[:] = sorted(d for d in dirs if not excluded(d, root_path + '/' + d, folder_excludes))
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                if path not in seen and not excluded(name, root_path + '/' + name, file_excludes):
+                    seen.add(path)
+                    yield path
+
+
+def count_lines(mm, a, b):
+    """Count the newlines between offsets a and b of mm, a chunk at a time."""
+    count = 0
+    while a < b:
+        end = min(a + COUNT_CHUNK, b)
+        count += mm[a:end].count(b'\n')
+        a = end
+    return count
+
+
+def search_file(args):
+    """
+    Search a file for regex (bytes), through a read-only memory map.
+
+    Returns (path, matches, error), with matches a list of (line number, line
+    text, matched strings) tuples, one per matching line.
+
+    """
+    path, regex, flags = args
+    matches = []
+    try:
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return path, matches, None
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if b'\0' in mm[:BINARY_SNIFF]:
+                    return path, matches, None
+                line_no = 1
+                pos = 0
+                last_line = None
+                for m in re.finditer(regex, mm, flags):
+                    start = m.start()
+                    line_no += count_lines(mm, pos, start)
+                    pos = start
+                    if last_line is not None and last_line[0] == line_no:
+                        last_line[2].append(m.group().decode('utf-8', 'replace'))
+                        continue
+                    if len(matches) == MAX_MATCHES:
+                        break
+                    line_start = mm.rfind(b'\n', 0, start) + 1
+                    line_end = mm.find(b'\n', start)
+                    if line_end < 0:
+                        line_end = len(mm)
+                    text = mm[line_start:min(line_end, line_start + MAX_LINE)].decode('utf-8', 'replace').rstrip('\r')
+                    last_line = (line_no, text, [m.group().decode('utf-8', 'replace')])
+                    matches.append(last_line)
+            finally:
+                mm.close()
+    except (IOError, OSError, ValueError) as e:
+        return path, [], str(e)
+    return path, matches, None
+
+
+def get_pool(processes=None):
+    """
+    Return a process pool, forking workers, or a thread pool where forking
+    isn't available (Windows, or Pythons without multiprocessing contexts).
+
+    """
+    # Imported here, multiprocessing takes a while to import and most
+    # sessions never search the project.
+    import multiprocessing
+    import multiprocessing.pool
+    processes = processes or min(4, multiprocessing.cpu_count() or 1)
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context and hasattr(os, 'fork'):
+        try:
+            return get_context('fork').Pool(processes)
+        except (ValueError, OSError):
+            pass
+    return multiprocessing.pool.ThreadPool(processes)
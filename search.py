@@ -0,0 +1,304 @@
+from __future__ import absolute_import
+
+import re
+import threading
+from bisect import bisect_right
+from collections import namedtuple, OrderedDict
+
+import sublime
+
+from .stats import stats, clock
+
+# A search pattern for string; word is set when the regex matches a whole
+# word, so it can be looked up in a word index instead of scanning the buffer.
+Pattern = namedtuple('Pattern', 'regex string word')
+
+
+class SearchCache(object):
+    """
+    LRU cache of search results, bounded by the total number of stored regions.
+
+    Entries are keyed by (buffer_id, change_count, regex, flags), so any edit
+    to a buffer makes its older results unreachable and they just age out.
+
+    """
+
+    def __init__(self, max_regions=200000):
+        self.max_regions = max_regions
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            regions = self.entries.pop(key, None)
+            if regions is None:
+                self.misses += 1
+                return None
+            self.entries[key] = regions
+            self.hits += 1
+            return list(regions)
+
+    def put(self, key, regions):
+        if len(regions) > self.max_regions:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = list(regions)
+            self.size += len(regions)
+            while self.size > self.max_regions:
+                key, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+cache = SearchCache()
+
+
+def compile_regex(regex, flags=0):
+    if flags & sublime.LITERAL:
+        regex = re.escape(regex)
+    return re.compile(regex, re.IGNORECASE if flags & sublime.IGNORECASE else 0)
+
+
+def line_region(view, region):
+    # Words never span lines, so searching whole lines keeps \b anchors sane
+    # at the edges of the searched region.
+    begin = view.line(region.begin()).begin()
+    end = region.end()
+    if end == region.begin() or view.substr(end - 1) != '\n':
+        end = view.line(end).end()
+    return sublime.Region(begin, end)
+
+
+def alternation(patterns):
+    # Longer terms go first so a term that's a prefix of another one doesn't
+    # shadow it in the alternation.
+    ordered = sorted(patterns, key=lambda p: len(p.string), reverse=True)
+    return '|'.join('(?:%s)' % p.regex for p in ordered)
+
+
+def search_region(view, regex, region, flags=0):
+    """Return the matches of regex inside region, as (region, matched text) tuples."""
+    regex = compile_regex(regex, flags)
+    region = line_region(view, region)
+    offset = region.begin()
+    content = view.substr(region)
+    return [(sublime.Region(offset + m.start(), offset + m.end()), m.group()) for m in regex.finditer(content)]
+
+
+def find_all(view, regex, region=None, flags=0):
+    """Find all matches of regex in view, optionally only inside region."""
+    if region is None:
+        key = (view.buffer_id(), view.change_count(), regex, flags)
+        regions = cache.get(key)
+        if regions is None:
+            t = clock()
+            regions = view.find_all(regex, flags)
+            stats.add('find_all', clock() - t)
+            cache.put(key, regions)
+        return regions
+    return [r for r, text in search_region(view, regex, region, flags)]
+
+
+def find_all_patterns(view, patterns, region=None, flags=0):
+    """
+    Find all matches of patterns in a single pass over view.
+
+    Returns a list with the regions matching each of the patterns; all the
+    patterns not already cached are searched for at once with an alternation,
+    and the matches are then split per term by their matched text.
+
+    """
+    results = {}
+    missing = []
+    for pattern in patterns:
+        if pattern.regex in results:
+            continue
+        regions = None
+        if region is None:
+            regions = cache.get((view.buffer_id(), view.change_count(), pattern.regex, flags))
+        if regions is None:
+            missing.append(pattern)
+            results[pattern.regex] = []
+        else:
+            results[pattern.regex] = regions
+
+    if len(missing) == 1:
+        results[missing[0].regex] = find_all(view, missing[0].regex, region, flags)
+    elif missing:
+        regex = alternation(missing)
+        if region is None:
+            extractions = []
+            t = clock()
+            regions = view.find_all(regex, flags, '$0', extractions)
+            stats.add('find_all', clock() - t)
+            matches = zip(regions, extractions)
+        else:
+            matches = search_region(view, regex, region, flags)
+        by_string = dict((p.string, results[p.regex]) for p in missing)
+        for r, text in matches:
+            found = by_string.get(text)
+            if found is not None:
+                found.append(r)
+        # Whole words can't overlap each other, so only then the split results
+        # are complete and can be cached as if searched for one at a time.
+        if region is None and all(p.word for p in missing):
+            for pattern in missing:
+                cache.put((view.buffer_id(), view.change_count(), pattern.regex, flags), results[pattern.regex])
+
+    return [results[p.regex] for p in patterns]
+
+
+def count_patterns(view, patterns, region=None, flags=0):
+    """
+    Count the matches of each of patterns in view, optionally only inside
+    region, without building any regions.
+
+    """
+    counts = {}
+    missing = []
+    for pattern in patterns:
+        if pattern.regex in counts:
+            continue
+        regions = None
+        if region is None:
+            regions = cache.get((view.buffer_id(), view.change_count(), pattern.regex, flags))
+        if regions is None:
+            missing.append(pattern)
+            counts[pattern.regex] = 0
+        else:
+            counts[pattern.regex] = len(regions)
+
+    if missing:
+        regex = compile_regex(alternation(missing), flags)
+        content = view.substr(sublime.Region(0, view.size()) if region is None else line_region(view, region))
+        by_string = dict((p.string, 0) for p in missing)
+        for m in regex.finditer(content):
+            text = m.group()
+            if text in by_string:
+                by_string[text] += 1
+        for pattern in missing:
+            counts[pattern.regex] = by_string[pattern.string]
+
+    return [counts[p.regex] for p in patterns]
+
+
+selector_cache = {}
+
+
+def selector_regions(view, selector, region=None):
+    """
+    Return the regions of view matching selector, merged into sorted spans
+    and optionally clipped to region.
+
+    The spans of the last few buffers and selectors are kept, so searching
+    one in slices doesn't go through all of its scopes again for each slice.
+
+    """
+    key = (view.buffer_id(), view.change_count(), selector)
+    spans = selector_cache.get(key)
+    if spans is None:
+        spans = []
+        for r in view.find_by_selector(selector):
+            if spans and r.begin() <= spans[-1][1]:
+                spans[-1] = (spans[-1][0], max(spans[-1][1], r.end()))
+            else:
+                spans.append((r.begin(), r.end()))
+        if len(selector_cache) >= 8:
+            selector_cache.clear()
+        selector_cache[key] = spans
+    if region is None:
+        return [sublime.Region(a, b) for a, b in spans]
+    begin, end = region.begin(), region.end()
+    i = max(0, bisect_right(spans, (begin, begin)) - 1)
+    clipped = []
+    for a, b in spans[i:]:
+        if a >= end:
+            break
+        if b > begin:
+            clipped.append(sublime.Region(max(a, begin), min(b, end)))
+    return clipped
+
+
+def line_spans(view, spans):
+    """
+    Group spans (sorted and disjoint) by the lines they're on, returning a
+    list of (lines, spans) tuples, so each line gets searched only once no
+    matter how many spans it holds.
+
+    """
+    groups = []
+    for span in spans:
+        if groups and span.end() <= groups[-1][0].end():
+            groups[-1][1].append(span)
+            continue
+        lines = line_region(view, span)
+        if groups and lines.begin() <= groups[-1][0].end():
+            group_lines, group_spans = groups[-1]
+            group_spans.append(span)
+            groups[-1] = (sublime.Region(group_lines.begin(), max(group_lines.end(), lines.end())), group_spans)
+        else:
+            groups.append((lines, [span]))
+    return groups
+
+
+def inside(regions, spans):
+    """Return the regions lying entirely inside one of spans (sorted and disjoint)."""
+    begins = [s.begin() for s in spans]
+    kept = []
+    for r in regions:
+        i = bisect_right(begins, r.begin()) - 1
+        if i >= 0 and spans[i].contains(r):
+            kept.append(r)
+    return kept
+
+
+def viewport_region(view, margin=0):
+    """Return the visible region of view, extended by margin lines."""
+    visible = view.visible_region()
+    row_a = view.rowcol(visible.begin())[0]
+    row_b = view.rowcol(visible.end())[0]
+    a = view.text_point(max(0, row_a - margin), 0)
+    b = min(view.text_point(row_b + margin, 0), view.size())
+    return view.line(sublime.Region(a, max(a, b)))
+
+
+def uncovered(region, covered):
+    """Return the parts of region not in covered (a sorted list of (a, b) spans)."""
+    gaps = []
+    a = region.begin()
+    end = region.end()
+    for ca, cb in covered:
+        if cb <= a:
+            continue
+        if ca >= end:
+            break
+        if ca > a:
+            gaps.append(sublime.Region(a, ca))
+        a = max(a, cb)
+    if a < end:
+        gaps.append(sublime.Region(a, end))
+    return gaps
+
+
+def cover(covered, region):
+    """Add region to covered (a sorted list of (a, b) spans), merging overlaps."""
+    a, b = region.begin(), region.end()
+    merged = []
+    for ca, cb in covered:
+        if cb < a or ca > b:
+            merged.append((ca, cb))
+        else:
+            a, b = min(a, ca), max(b, cb)
+    merged.append((a, b))
+    merged.sort()
+    return merged
@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+
+import time
+import functools
+from collections import deque
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class Stats(object):
+    """
+    Always-on, low-overhead performance counters.
+
+    Timings are kept in a rolling window per phase, so recording one is just
+    an append; percentiles are only computed when a report is requested.
+
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.timings = {}
+        self.totals = {}
+        self.counters = {}
+
+    def add(self, name, elapsed):
+        try:
+            self.timings[name].append(elapsed)
+        except KeyError:
+            self.timings[name] = deque([elapsed], self.window)
+        self.totals[name] = self.totals.get(name, 0) + elapsed
+        self.counters[name] = self.counters.get(name, 0) + 1
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def percentiles(self, name, ps=(50, 95, 99)):
+        samples = sorted(self.timings.get(name, ()))
+        if not samples:
+            return [0.0] * len(ps)
+        return [samples[min(len(samples) - 1, len(samples) * p // 100)] for p in ps]
+
+    def clear(self):
+        self.timings.clear()
+        self.totals.clear()
+        self.counters.clear()
+
+    def report(self, extra=None):
+        lines = ["%-32s %8s %9s %9s %9s %11s" % ("phase", "count", "p50 ms", "p95 ms", "p99 ms", "total ms")]
+        for name in sorted(self.timings):
+            p50, p95, p99 = self.percentiles(name)
+            lines.append("%-32s %8d %9.3f %9.3f %9.3f %11.3f" % (name, self.counters[name], p50 * 1000, p95 * 1000, p99 * 1000, self.totals[name] * 1000))
+        lines.append("")
+        lines.append("%-32s %8s" % ("counter", "value"))
+        counters = dict((k, v) for k, v in self.counters.items() if k not in self.timings)
+        counters.update(extra or {})
+        for name in sorted(counters):
+            lines.append("%-32s %8d" % (name, counters[name]))
+        return "\n".join(lines) + "\n"
+
+
+stats = Stats()
+
+
+def timed(name):
+    """Decorator recording the time taken by each call to the function as name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.add(name, clock() - start)
+        return wrapper
+    return decorator
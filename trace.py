@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+
+import os
+import json
+import time
+import threading
+
+import sublime
+
+FLUSH_DELAY = 1000  # ms
+
+set_timeout_async = getattr(sublime, 'set_timeout_async', sublime.set_timeout)
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class TraceRecorder(object):
+    """
+    Opt-in recorder of the editing events Text Marker reacts to.
+
+    Each event is written as a compact JSON list per line, starting with its
+    kind and the milliseconds since the recording started:
+
+        ["v", t, view id, size]                                 view first seen
+        ["s", t, view id, size, change count, [[a, b], ...]]    selection modified
+        ["m", t, view id, size, change count]                   buffer modified
+        ["c", t, view id, [[a, b, inserted length], ...]]       text changes (ST4)
+
+    Only offsets and sizes are recorded, never the text itself. Lines are
+    buffered and written off the UI thread.
+
+    """
+
+    def __init__(self):
+        self.path = None
+        self.start = None
+        self.views = set()
+        self.lines = []
+        self.pending = False
+        self.lock = threading.Lock()
+        self.writing = threading.Lock()
+
+    @property
+    def active(self):
+        return self.path is not None
+
+    def trace_path(self):
+        cache_path = getattr(sublime, 'cache_path', None)
+        base = os.path.join(cache_path(), 'Text Marker') if cache_path else os.path.join(sublime.packages_path(), 'User')
+        return os.path.join(base, 'traces', time.strftime('trace-%Y%m%d-%H%M%S.jsonl'))
+
+    def begin(self, settings=None):
+        """Start recording into a new trace file, returning its path."""
+        if self.active:
+            return self.path
+        path = self.trace_path()
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        self.views = set()
+        self.start = clock()
+        self.path = path
+        self.lines = [json.dumps(['trace', 1, sublime.version(), sublime.platform(), settings or {}], separators=(',', ':'))]
+        self.flush()
+        return path
+
+    def end(self):
+        """Stop recording, returning the path of the trace file."""
+        path = self.path
+        if path is not None:
+            self.flush()
+            self.path = None
+        return path
+
+    def record(self, *event):
+        with self.lock:
+            self.lines.append(json.dumps(event, separators=(',', ':')))
+            if self.pending:
+                return
+            self.pending = True
+        set_timeout_async(self.flush, FLUSH_DELAY)
+
+    def elapsed(self):
+        return int((clock() - self.start) * 10000) / 10.0
+
+    def view(self, view):
+        vid = view.id()
+        if vid not in self.views:
+            self.views.add(vid)
+            self.record('v', self.elapsed(), vid, view.size())
+        return vid
+
+    def selection(self, view):
+        vid = self.view(view)
+        self.record('s', self.elapsed(), vid, view.size(), view.change_count(), [[s.a, s.b] for s in view.sel()])
+
+    def modified(self, view):
+        vid = self.view(view)
+        self.record('m', self.elapsed(), vid, view.size(), view.change_count())
+
+    def changes(self, view, changes):
+        vid = self.view(view)
+        self.record('c', self.elapsed(), vid, [list(c) for c in changes])
+
+    def flush(self):
+        # Writes are serialized so lines land in the file in the order recorded.
+        with self.writing:
+            with self.lock:
+                lines, self.lines = self.lines, []
+                self.pending = False
+                path = self.path
+            if path and lines:
+                with open(path, 'a') as f:
+                    f.write('\n'.join(lines) + '\n')
+
+
+recorder = TraceRecorder()
+
+
+def load_trace(path):
+    """Return the header and the list of events of the trace file at path."""
+    header = None
+    events = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            event = json.loads(line)
+            if event[0] == 'trace':
+                header = event
+            else:
+                events.append(event)
+    return header, events
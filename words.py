@@ -0,0 +1,182 @@
+from __future__ import absolute_import
+
+import re
+import time
+from array import array
+from bisect import bisect_right
+
+import sublime
+
+CHUNK_SIZE = 65536  # characters per indexed chunk (rounded up to a full line)
+IDLE_DELAY = 1000  # ms the buffer must stay unmodified before (re)building
+BUILD_BUDGET = 0.02  # seconds spent tokenizing per build step
+
+clock = getattr(time, 'perf_counter', time.time)
+
+set_timeout_async = getattr(sublime, 'set_timeout_async', sublime.set_timeout)
+
+
+def is_word(string, word_separators):
+    return bool(string) and not any(c.isspace() or c in word_separators for c in string)
+
+
+class WordIndex(object):
+    """
+    Inverted index mapping each word in a buffer to its offsets.
+
+    The buffer is split into line aligned chunks, each holding the offsets of
+    its words relative to the chunk start, so an edit only re-tokenizes the
+    chunks it touches and merely shifts the start of the following ones.
+
+    Offsets are kept in arrays, and each distinct word is stored only once
+    for all the chunks, so the index stays a few times the size of the text.
+
+    """
+
+    def __init__(self, view):
+        self.word_separators = view.settings().get('word_separators') or ''
+        self.regex = re.compile(r'[^\s%s]+' % re.escape(self.word_separators))
+        self.change_count = None
+        self.chunks = None  # list of (start, size, words) tuples
+        self.strings = {}  # the single copy kept of each word
+        self.building = False
+
+    def chunk(self, view, start, end):
+        """Tokenize the chunk starting at start, ending by end; returns its (start, size, words) tuple."""
+        stop = min(view.full_line(min(start + CHUNK_SIZE, end)).end(), end)
+        if stop <= start:
+            stop = end
+        offsets = {}
+        for m in self.regex.finditer(view.substr(sublime.Region(start, stop))):
+            offsets.setdefault(m.group(), []).append(m.start())
+        strings = self.strings
+        words = {}
+        for word, found in offsets.items():
+            words[strings.setdefault(word, word)] = array('I', found)
+        return (start, stop - start, words)
+
+    def tokenize(self, view, start, end):
+        chunks = []
+        while start < end:
+            chunk = self.chunk(view, start, end)
+            chunks.append(chunk)
+            start += chunk[1]
+        return chunks
+
+    def update(self, view, changes):
+        """Patch the index for changes, a list of (a, b, inserted length) tuples in order."""
+        if self.chunks is None:
+            return
+        chunks = list(self.chunks) or [(0, 0, None)]
+        for a, b, length in changes:
+            delta = length - (b - a)
+            touched = [i for i, (start, size, words) in enumerate(chunks) if start <= b and start + size >= a]
+            if not touched:
+                touched = [len(chunks) - 1]
+            i, j = touched[0], touched[-1]
+            start = chunks[i][0]
+            size = sum(chunks[k][1] for k in range(i, j + 1)) + delta
+            chunks[i:j + 1] = [(start, size, None)]
+            chunks[i + 1:] = [(s + delta, n, w) for s, n, w in chunks[i + 1:]]
+        patched = []
+        for start, size, words in chunks:
+            if words is None:
+                patched.extend(self.tokenize(view, start, start + size))
+            else:
+                patched.append((start, size, words))
+        self.chunks = patched
+        self.change_count = view.change_count()
+
+    def count(self, word):
+        """Return the number of times word occurs."""
+        return sum(len(words.get(word, ())) for start, size, words in self.chunks)
+
+    def find(self, word, region=None):
+        """Return the regions where word occurs, optionally only inside region."""
+        length = len(word)
+        regions = []
+        chunks = self.chunks
+        if region is not None:
+            # Chunks are sorted by start, so only the ones overlapping region
+            # are looked at; (start,) sorts before any chunk starting there.
+            i = max(0, bisect_right(chunks, (region.begin(),)) - 1)
+            chunks = []
+            for chunk in self.chunks[i:]:
+                if chunk[0] > region.end():
+                    break
+                chunks.append(chunk)
+        for start, size, words in chunks:
+            offsets = words.get(word)
+            if offsets:
+                regions.extend(sublime.Region(start + o, start + o + length) for o in offsets)
+        if region is not None:
+            regions = [r for r in regions if region.contains(r)]
+        return regions
+
+
+indexes = {}
+
+
+def get_index(view, max_size=None):
+    """
+    Return the word index for view if it's up to date, scheduling a build
+    otherwise; buffers larger than max_size don't get one.
+
+    """
+    buffer_id = view.buffer_id()
+    if max_size and view.size() > max_size:
+        indexes.pop(buffer_id, None)
+        return None
+    index = indexes.get(buffer_id)
+    if index is None or index.word_separators != (view.settings().get('word_separators') or ''):
+        index = indexes[buffer_id] = WordIndex(view)
+    if index.chunks is not None and index.change_count == view.change_count():
+        return index
+    if not index.building:
+        index.building = True
+        schedule_build(view, index, view.change_count())
+
+
+def schedule_build(view, index, change_count):
+    # Only build once the buffer has been left alone for a while, so a burst
+    # of edits doesn't trigger a full rebuild for each of them.
+    def build():
+        if view.change_count() != change_count:
+            schedule_build(view, index, view.change_count())
+        else:
+            index.strings = {}
+            build_step(view, index, change_count, 0, [])
+    set_timeout_async(build, IDLE_DELAY)
+
+
+def build_step(view, index, change_count, pos, chunks):
+    # Tokenizing a large buffer takes a while, so it's done a bit at a time
+    # to let the other callbacks in the plugin host run in between.
+    if not getattr(view, 'is_valid', lambda: True)() or indexes.get(view.buffer_id()) is not index:
+        index.building = False
+        return
+    if view.change_count() != change_count:
+        schedule_build(view, index, view.change_count())
+        return
+    size = view.size()
+    deadline = clock() + BUILD_BUDGET
+    while pos < size and clock() < deadline:
+        chunk = index.chunk(view, pos, size)
+        chunks.append(chunk)
+        pos += chunk[1]
+    if pos < size:
+        set_timeout_async(lambda: build_step(view, index, change_count, pos, chunks), 0)
+    else:
+        index.chunks = chunks
+        index.change_count = change_count
+        index.building = False
+
+
+def update_index(view, changes):
+    index = indexes.get(view.buffer_id())
+    if index is not None and not index.building:
+        index.update(view, changes)
+
+
+def drop_index(view):
+    indexes.pop(view.buffer_id(), None)